@@ -0,0 +1,144 @@
+import numpy as np
+import scipy.ndimage
+import config
+"""
+On the fly augmentation of batches of HU volumes (batch, slices, rows, columns), applied by loader.py's workers
+before normalization, so augmented copies never hit the disk.
+
+All random parameters of a batch are drawn up front from one np.random.RandomState (draw_params), and
+apply() is deterministic given them, so a batch is reproducible from its seed no matter how the work is
+spread over threads. Flips, 90 degree turns, HU jitter and crops are vectorized over the batch; only the
+interpolated rotation / shift is done per sample (with scipy.ndimage, optionally on a thread pool).
+"""
+
+
+air = -1000.
+
+
+def draw_params(rng, n, flip_axes=None, rot90=None, max_rotation=None, max_shift=None, hu_scale=None,
+                hu_offset=None, hu_noise=None, crop_margin=None):
+    """
+    :param rng: np.random.RandomState
+    :param n: batch size
+    :return: dict of per sample parameters; other arguments default to the config.augment_* values
+    """
+    flip_axes = config.augment_flip_axes if flip_axes is None else flip_axes
+    rot90 = config.augment_rot90 if rot90 is None else rot90
+    max_rotation = config.augment_max_rotation if max_rotation is None else max_rotation
+    max_shift = config.augment_max_shift if max_shift is None else max_shift
+    hu_scale = config.augment_hu_scale if hu_scale is None else hu_scale
+    hu_offset = config.augment_hu_offset if hu_offset is None else hu_offset
+    hu_noise = config.augment_hu_noise if hu_noise is None else hu_noise
+    crop_margin = config.augment_crop_margin if crop_margin is None else crop_margin
+    return dict(flips=dict((axis, rng.rand(n) < .5) for axis in flip_axes),
+                rot90=rng.randint(4, size=n) if rot90 else np.zeros(n, dtype=int),
+                rotation=rng.uniform(-max_rotation, max_rotation, size=n),
+                shift=rng.uniform(-max_shift, max_shift, size=(n, 3)),
+                hu_scale=1. + rng.uniform(-hu_scale, hu_scale, size=n),
+                hu_offset=rng.uniform(-hu_offset, hu_offset, size=n),
+                hu_noise=hu_noise,
+                noise_seed=rng.randint(2 ** 31),
+                crop_margin=crop_margin,
+                crop_offset=rng.randint(2 * crop_margin + 1, size=(n, 3)))
+
+
+def jitter_hu(x, params):
+    """
+    Per sample scale and offset plus gaussian noise, in HU, in place.
+    """
+    x *= params['hu_scale'][:, None, None, None].astype(x.dtype)
+    x += params['hu_offset'][:, None, None, None].astype(x.dtype)
+    if params['hu_noise']:
+        noise_rng = np.random.RandomState(params['noise_seed'])
+        x += (noise_rng.standard_normal(x.shape) * params['hu_noise']).astype(x.dtype)
+    return x
+
+
+def flip(x, params):
+    for axis, selected in sorted(params['flips'].items()):
+        if selected.any():
+            # axis of a volume is axis + 1 of the batch
+            x[selected] = np.flip(x[selected], axis + 1)
+    return x
+
+
+def rotate90(x, params):
+    """
+    Quarter turns in the axial (rows, columns) plane; only half turns if the slices aren't square.
+    """
+    k = params['rot90'] if x.shape[2] == x.shape[3] else params['rot90'] // 2 * 2
+    for turns in np.unique(k):
+        if turns:
+            selected = k == turns
+            x[selected] = np.rot90(x[selected], turns, axes=(2, 3))
+    return x
+
+
+def affine_matrix(degrees):
+    # rotation about the slice axis, in (slices, rows, columns) coordinates
+    a = np.deg2rad(degrees)
+    return np.array([[1., 0., 0.],
+                     [0., np.cos(a), -np.sin(a)],
+                     [0., np.sin(a), np.cos(a)]])
+
+
+def affine(volume, degrees, shift, order=1):
+    """
+    Rotate volume about its center by degrees in the axial plane and shift it by shift voxels, filling with air.
+    """
+    matrix = affine_matrix(degrees)
+    center = (np.array(volume.shape) - 1) / 2.
+    # affine_transform maps output coordinates to input coordinates: in = matrix . (out - center) + center - shift
+    offset = center - matrix.dot(center) - shift
+    return scipy.ndimage.affine_transform(volume, matrix, offset=offset, order=order, mode='constant', cval=air)
+
+
+def affine_batch(x, params, pool=None, order=1):
+    """
+    :param pool: executor with a map method to spread the samples over, e.g. the loader's thread pool
+    """
+    todo = [i for i in range(len(x)) if params['rotation'][i] or params['shift'][i].any()]
+
+    def transform(i):
+        x[i] = affine(x[i], params['rotation'][i], params['shift'][i], order)
+
+    list((pool.map if pool is not None else map)(transform, todo))
+    return x
+
+
+def random_crop(x, params):
+    """
+    Pad every side with crop_margin voxels of air and take a random crop of the original shape, i.e. a random
+    whole voxel translation.
+    """
+    m = params['crop_margin']
+    if not m:
+        return x
+    padded = np.pad(x, [(0, 0)] + [(m, m)] * 3, mode='constant', constant_values=air)
+    shape = x.shape[1:]
+    for i, (z, y, c) in enumerate(params['crop_offset']):
+        x[i] = padded[i, z:z + shape[0], y:y + shape[1], c:c + shape[2]]
+    return x
+
+
+def apply(x, params, pool=None):
+    """
+    Augment a batch of HU volumes in place.
+    :param x: float array (batch, slices, rows, columns)
+    :return: x
+    """
+    flip(x, params)
+    rotate90(x, params)
+    affine_batch(x, params, pool)
+    random_crop(x, params)
+    # last, so the air that affine and random_crop fill new borders with is scaled, shifted and noisy like the rest
+    # of the volume, rather than an exact -1000 HU edge the model could learn
+    return jitter_hu(x, params)
+
+
+def augment_batch(x, seed, pool=None, **kwargs):
+    """
+    Augment a batch of HU volumes in place with parameters drawn from seed (kwargs override the config.augment_*
+    values, see draw_params).
+    """
+    return apply(x, draw_params(np.random.RandomState(seed), len(x), **kwargs), pool)
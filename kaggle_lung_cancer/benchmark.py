@@ -0,0 +1,197 @@
+"""
+Training and inference throughput of the repo's models on synthetic inputs, across batch sizes and thread counts:
+
+    mnist_softmax   neural_nets/mnist_softmax.py's softmax regression (tensorflow), 784 pixel inputs
+    dummy           learn.dummy_model, 784 inputs
+    lung            learn.lung_model, (1,) + config.lung_crop_shape lung crops
+
+    python benchmark.py --save_baseline                 # record a baseline on this machine
+    python benchmark.py --models lung --modes train     # compare against it; exits with 1 on regressions
+
+Every configuration runs in a fresh process, so thread settings take effect and peak memory is its own. Only
+the model step is timed (the inputs are generated once up front); the first --warmup steps are not timed.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import config, utils, profiling
+
+
+columns = ['model', 'mode', 'batch_size', 'n_threads', 'steps', 'samples_per_sec', 'p50_ms', 'p90_ms', 'p99_ms',
+           'peak_rss_mb']
+keys = ['model', 'mode', 'batch_size', 'n_threads']
+
+
+def _session_config(n_threads):
+    import tensorflow as tf
+    return tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=n_threads)
+
+
+def mnist_softmax_step(mode, batch_size, n_threads, seed=0):
+    """
+    :return: function running one training step (or prediction) of mnist_softmax on a synthetic batch
+    """
+    import tensorflow as tf
+    sys.path.insert(0, os.path.join(utils.file_dir(__file__), '..', 'neural_nets'))
+    import mnist_softmax
+    rng = np.random.RandomState(seed)
+    x = tf.placeholder(tf.float32, [None, 784])
+    y_ = tf.placeholder(tf.float32, [None, 10])
+    y = mnist_softmax.softmax_regression()(x)
+    op = mnist_softmax.train_op(y, y_) if mode == 'train' else y
+    sess = tf.Session(config=_session_config(n_threads))
+    sess.run(tf.global_variables_initializer())
+    feed = {x: rng.random_sample((batch_size, 784)).astype(np.float32),
+            y_: np.eye(10, dtype=np.float32)[rng.randint(10, size=batch_size)]}
+    return lambda: sess.run(op, feed_dict=feed)
+
+
+def keras_step(build, input_shape, n_classes):
+    """
+    :param build: name of the learn.py function building (and compiling) the model
+    :param n_classes: 1 for a sigmoid output, else the size of a one hot output
+    """
+    def step(mode, batch_size, n_threads, seed=0):
+        from keras import backend as K
+        if K.backend() == 'tensorflow':
+            import tensorflow as tf
+            K.set_session(tf.Session(config=_session_config(n_threads)))
+        import learn
+        rng = np.random.RandomState(seed)
+        model = getattr(learn, build)()
+        x = rng.random_sample((batch_size,) + tuple(input_shape)).astype(np.float32)
+        if n_classes == 1:
+            y = rng.randint(2, size=(batch_size, 1))
+        else:
+            y = np.eye(n_classes, dtype=np.float32)[rng.randint(n_classes, size=batch_size)]
+        if mode == 'train':
+            return lambda: model.train_on_batch(x, y)
+        return lambda: model.predict_on_batch(x)
+    return step
+
+
+# model name -> (function making the step function, default batch sizes)
+models = dict(mnist_softmax=(mnist_softmax_step, [32, 100, 256]),
+              dummy=(keras_step('dummy_model', (784,), 1), [32, 128]),
+              lung=(keras_step('lung_model', (1,) + tuple(config.lung_crop_shape), 2), [4, 24]))
+
+
+def run(model, mode, batch_size, n_threads, steps=20, warmup=3):
+    """
+    Time one configuration (in this process; see run_isolated).
+    :return: dict of the columns
+    """
+    # for BLAS / openmp backends (theano, numpy); tensorflow gets a session config:
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    step = models[model][0](mode, batch_size, n_threads)
+    for _ in range(warmup):
+        step()
+    latencies = np.empty(steps)
+    for i in range(steps):
+        start = time.time()
+        step()
+        latencies[i] = time.time() - start
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000.
+    return dict(model=model, mode=mode, batch_size=batch_size, n_threads=n_threads, steps=steps,
+                samples_per_sec=batch_size * steps / latencies.sum(), p50_ms=p50, p90_ms=p90, p99_ms=p99,
+                peak_rss_mb=profiling.peak_rss_mb())
+
+
+def _run_job(args):
+    return run(*args)
+
+
+def run_isolated(*args):
+    # a fresh process per configuration, which must not have imported tensorflow / keras yet
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        return pool.apply(_run_job, (args,))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_all(model_names, modes, n_threads_list, batch_sizes=None, steps=20, warmup=3):
+    """
+    :param batch_sizes: batch sizes for every model, or None for each model's defaults
+    :return: DataFrame of the results of every configuration that could run
+    """
+    results = []
+    for model in model_names:
+        for mode in modes:
+            for batch_size in batch_sizes or models[model][1]:
+                for n_threads in n_threads_list:
+                    try:
+                        result = run_isolated(model, mode, batch_size, n_threads, steps, warmup)
+                    except Exception as e:
+                        # e.g. keras or tensorflow isn't installed, or the batch doesn't fit in memory
+                        print('{} {} batch {} threads {}: failed: {!r}'.format(model, mode, batch_size, n_threads, e))
+                        continue
+                    print('{model} {mode} batch {batch_size} threads {n_threads}: {samples_per_sec:.1f} samples/sec, '
+                          'p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, peak {peak_rss_mb:.0f} MB'.format(**result))
+                    results.append(result)
+    return pd.DataFrame(results, columns=columns)
+
+
+def compare(results, baseline, tolerance=.1):
+    """
+    :param tolerance: throughput may drop by this fraction of the baseline before it counts as a regression
+    :return: the results with the baseline's samples/sec and p50, their ratio and a regression flag, for the
+        configurations present in both
+    """
+    merged = results.merge(baseline[keys + ['samples_per_sec', 'p50_ms']], on=keys, suffixes=('', '_baseline'))
+    merged['ratio'] = merged.samples_per_sec / merged.samples_per_sec_baseline
+    merged['regression'] = merged.ratio < 1 - tolerance
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', default=','.join(sorted(models)), help='comma separated')
+    parser.add_argument('--modes', default='train,predict', help='comma separated: train, predict')
+    parser.add_argument('--batch_sizes', default=None, help="comma separated; defaults to each model's own")
+    parser.add_argument('--threads', default='1,{}'.format(multiprocessing.cpu_count()), help='comma separated')
+    parser.add_argument('--steps', type=int, default=20, help='timed steps per configuration')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps first')
+    parser.add_argument('--output', default=None, help='csv to write the results to')
+    parser.add_argument('--baseline', default=None,
+                        help='csv of earlier results (default config.benchmark_baseline)')
+    parser.add_argument('--save_baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help='throughput drop (fraction of the baseline) that counts as a regression')
+    config.add_arguments(parser)
+    args = parser.parse_args()
+    config.apply_arguments(args)
+    args.baseline = args.baseline or config.benchmark_baseline
+
+    def ints(s):
+        return sorted(set(int(v) for v in s.split(',')))
+
+    results = run_all(args.models.split(','), args.modes.split(','), ints(args.threads),
+                      ints(args.batch_sizes) if args.batch_sizes else None, args.steps, args.warmup)
+    pd.set_option('display.width', 200)
+    print(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    if args.save_baseline:
+        utils.safe_mkdirs(os.path.dirname(args.baseline) or '.')
+        results.to_csv(args.baseline, index=False)
+        print('Saved the baseline to {}'.format(args.baseline))
+    elif os.path.isfile(args.baseline):
+        comparison = compare(results, pd.read_csv(args.baseline), args.tolerance)
+        print(comparison[keys + ['samples_per_sec', 'samples_per_sec_baseline', 'ratio', 'regression']])
+        regressions = comparison[comparison.regression]
+        if len(regressions):
+            print('{} regression(s) beyond {:.0%} of the baseline'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+    else:
+        print('No baseline at {}; run with --save_baseline to record one'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
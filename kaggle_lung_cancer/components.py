@@ -0,0 +1,70 @@
+import numpy as np
+import scipy.ndimage
+"""
+Connected component statistics in O(n) with np.bincount, rather than sorting every voxel with np.unique.
+Label arrays are the output of skimage.measure.label (or scipy.ndimage.label): non-negative ints.
+"""
+
+
+def label_sizes(labels, n_labels=None):
+    """
+    :return: voxel count of every label 0 .. max label (or n_labels - 1), indexed by label
+    """
+    return np.bincount(np.asarray(labels).ravel(), minlength=n_labels or 0)
+
+
+def largest_label(labels, bg=0):
+    """
+    :param bg: label to ignore (e.g. 0 for the background), or None
+    :return: the label with the most voxels, or None if there are no labels other than bg
+    """
+    sizes = label_sizes(labels)
+    if bg is not None and 0 <= bg < len(sizes):
+        sizes[bg] = 0
+    if not sizes.any():
+        return None
+    return int(np.argmax(sizes))
+
+
+def component_stats(labels, bg=0):
+    """
+    Sizes, centroids and bounding boxes of all components, computed one axial slice at a time so that the only
+    temporaries are slice sized.
+    :param labels: 2d or 3d label array
+    :param bg: label to leave out of the results, or None
+    :return: dict of arrays indexed by position in 'labels':
+        labels: the component labels, largest first
+        sizes: voxel counts
+        centroids: (n, ndim) mean voxel coordinates
+        bboxes: (n, ndim, 2) half open [start, stop) ranges per axis
+    """
+    labels = np.asarray(labels)
+    n = int(labels.max()) + 1 if labels.size else 1
+    sizes = np.zeros(n, dtype=np.int64)
+    coord_sums = np.zeros((n, labels.ndim), dtype=np.float64)
+    # coordinates within one axial slice, raveled the same way as the slice:
+    slice_coords = [c.ravel() for c in np.indices(labels.shape[1:])]
+    for z in range(labels.shape[0]):
+        flat = labels[z].ravel()
+        counts = np.bincount(flat, minlength=n)
+        sizes += counts
+        coord_sums[:, 0] += z * counts
+        for axis, coords in enumerate(slice_coords):
+            coord_sums[:, axis + 1] += np.bincount(flat, weights=coords, minlength=n)
+
+    present = np.flatnonzero(sizes)
+    if bg is not None:
+        present = present[present != bg]
+    present = present[np.argsort(-sizes[present], kind='mergesort')]
+
+    bboxes = np.zeros((len(present), labels.ndim, 2), dtype=np.int64)
+    objects = scipy.ndimage.find_objects(labels)
+    for i, l in enumerate(present):
+        if l == 0:
+            # find_objects skips label 0
+            bboxes[i] = [(s.start, s.stop) for s in scipy.ndimage.find_objects((labels == 0).view(np.int8))[0]]
+        else:
+            bboxes[i] = [(s.start, s.stop) for s in objects[l - 1]]
+
+    return dict(labels=present, sizes=sizes[present],
+                centroids=coord_sums[present] / sizes[present, None], bboxes=bboxes)
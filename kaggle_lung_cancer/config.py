@@ -1,12 +1,43 @@
-import pandas as pd
+import argparse
+import ast
+import os
+import types
+import numpy as np
 """
 Configuration values
+
+Any of them can be overridden without editing this file:
+    - in the environment, as KLC_<NAME> (e.g. KLC_DATA_DIR=/mnt/kaggle/ KLC_N_JOBS=8), applied when config is
+      first imported, so every process (including pool workers) sees them;
+    - on the command line of the scripts, as --data_dir DIR and --set NAME=VALUE (see parse_args), applied when
+      the script starts. Values that other modules derive at import time (e.g. loader.input_shape from
+      lung_crop_shape) only follow the environment.
+Values are python literals (8, None, (24, 128, 128)); anything else is taken as a string.
 """
 
 
-input_data_dir = 'data/'
-input_images_dir = 'data/stage1/'
-processed_images_dir = 'data/processed_images/'
+def set_data_dir(d):
+    """
+    Point all the data paths below at the data directory d.
+    """
+    global data_dir, input_data_dir, input_images_dir, processed_images_dir, dataset_dir, stage_cache_dir, \
+        profile_log, benchmark_baseline
+    data_dir = d if d.endswith('/') else d + '/'
+    input_data_dir = data_dir
+    input_images_dir = data_dir + 'stage1/'
+    processed_images_dir = data_dir + 'processed_images/'
+    # sharded training dataset exported by dataset.py:
+    dataset_dir = data_dir + 'dataset/'
+    # intermediate preprocessing stage results (see stage_cache.py), None to disable:
+    stage_cache_dir = data_dir + 'stage_cache/'
+    # per stage, per patient timings and memory / io of the pipeline (see profiling.py), None to disable:
+    profile_log = data_dir + 'profile.jsonl'
+    # model throughput results benchmark.py compares against (see benchmark.py --save_baseline):
+    benchmark_baseline = data_dir + 'benchmark_baseline.csv'
+
+
+# root of the data paths (labels, DICOM scans, processed volumes, caches, logs):
+set_data_dir('data/')
 plots_dir = 'plots/'
 
 
@@ -19,18 +50,217 @@ file_pixels_resampled = 'pixels_resampled'
 file_pixels_resampled_spacing = 'pixels_resampled_spacing'
 file_segmented_lungs = 'segmented_lungs'
 file_segmented_lungs_fill = 'segmented_lungs_fill'
+file_hu_counts = 'hu_counts'
+file_lungs_cropped = 'lungs_cropped'
+# patch centers / spatial index of a patient (see patches.py):
+file_patches = 'patches.npz'
+# all of a patient's processed volumes (see volume_store.py), stored under the file names above:
+file_volumes = 'volumes.vol'
+# list of patients preprocessing has fully finished, used to resume interrupted runs:
+file_manifest = 'manifest.txt'
+
+# number of worker processes for preprocessing; None means one per core:
+n_jobs = None
+# threads each preprocessing worker uses to decode a patient's DICOM slices:
+dicom_threads = 4
+# voxel size (z, y, x, in mm) the scans are resampled to:
+new_spacing = (1, 1, 1)
+# interpolation used to resample the scans to new_spacing ('nearest', 'linear' or 'cubic'), and threads per worker.
+# Linear is several times faster than cubic and close enough on a 1mm grid (run resampling.py to compare):
+resample_order = 'linear'
+resample_threads = 1
+# HU threshold between air and tissue of the lung segmentation, and threads per worker for its per-slice part:
+segment_threshold = -320
+segment_threads = 1
+# size limit of the stage cache; least recently used entries are removed beyond it:
+stage_cache_max_bytes = 200 * 1024 ** 3
+# the lungs' bounding box (plus a margin in voxels) is cropped and resampled to a fixed shape for training,
+# optionally with everything outside the lung mask set to air:
+lung_crop_shape = (24, 128, 128)
+lung_crop_margin = 5
+lung_crop_masked = False
+# dtype the lung crops are stored in: 'uint8' keeps only normalize()'s HU window, quantized to 256 levels
+# (see preprocessing.window_uint8); 'int16' keeps the HU values:
+lung_crop_dtype = 'uint8'
+# dtype of the training / prediction batches ('float32', or 'float16' if the model's backend uses it):
+input_dtype = 'float32'
+# patches: shape, sliding window stride (voxels) and the HU threshold of nodule candidates:
+patch_shape = lung_crop_shape
+patch_stride = (12, 64, 64)
+candidate_threshold = -400
+# training augmentation (see augment.py), drawn independently per sample: flips along these axes of
+# (slices, rows, columns), random 90 degree turns in the axial plane, rotation about the slice axis of up to
+# this many degrees and shifts of up to this many voxels (interpolated), HU jitter (relative scale, offset and
+# gaussian noise in HU), and random crops after padding every side with this many voxels of air:
+augment_flip_axes = (2,)
+augment_rot90 = True
+augment_max_rotation = 10.
+augment_max_shift = 2.
+augment_hu_scale = .05
+augment_hu_offset = 20.
+augment_hu_noise = 5.
+augment_crop_margin = 4
+
+# volume file layout: axial slices per chunk, and whether to zlib compress chunks (compressed volumes can't be
+# memory mapped, but single slices / sub-cubes can still be read without reading the whole volume):
+volume_chunk_slices = 16
+volume_compress = False
+
+# ct scan animations: keep every n-th slice / every n-th row and column:
+gif_stride = 1
+gif_downscale = 1
+# 3d lung plots: marching cubes step size (voxels), block max downsampling before it, and optional vertex
+# clustering cell size (voxels, None to keep every vertex):
+mesh_step_size = 2
+mesh_downsample = 1
+mesh_decimate_cell = None
+
+
+# Hounsfield unit buckets as (name, average value, color, min value, r, g, b), sorted by min value. A value belongs
+# to the bucket with the largest min value below it (see klc_utils.py):
+housefield_buckets = [
+    ('air', -1000, '#5080cc', -10000, 170, 200, 240),
+    ('lung', -500, 'pink', -750, 238, 136, 186),
+    ('fat', -75, 'grey', -150, 150, 150, 150),
+    ('water', 0, 'blue', -25, 50, 50, 250),
+    # ('csf', 15, '#90aaff', 5),
+    ('muscle', 25, 'red', 5, 250, 30, 30),
+    ('blood', 37.5, 'darkred', 30, 170, 40, 40),
+    ('liver', 50, 'green', 45, 65, 205, 130),
+    ('soft_tissue', 200, 'yellow', 75, 220, 200, 50),
+    ('bone', 700, 'white', 500, 245, 255, 255)]
+
+
+# built on first use, and reset if housefield_buckets is overridden:
+_bucket_table = None
+_bucket_frame = None
+
+
+def housefield_bucket_table():
+    """
+    housefield_buckets as numpy arrays, built once on first use.
+    :return: dict of 'labels', 'average_values', 'colors', 'edges' (the min values) and an (n_buckets, 3) 'rgb'
+        table with values in [0, 1]
+    """
+    global _bucket_table
+    if _bucket_table is None:
+        labels, average_values, colors, min_values = list(zip(*housefield_buckets))[:4]
+        _bucket_table = dict(labels=np.array(labels),
+                             average_values=np.array(average_values, dtype=np.float64),
+                             colors=np.array(colors),
+                             edges=np.array(min_values, dtype=np.float64),
+                             rgb=np.array([b[4:7] for b in housefield_buckets], dtype=np.float64) / 255.)
+    return _bucket_table
+
+
+def __getattr__(name):
+    # the old pandas version of the bucket table, only built (and pandas only imported) if something asks for it
+    global _bucket_frame
+    if name == 'housefield_unit_buckets':
+        if _bucket_frame is None:
+            import pandas as pd
+            table = housefield_bucket_table()
+            _bucket_frame = pd.DataFrame(dict(average_value=table['average_values'], color=table['colors'],
+                                              min_value=table['edges'], r=[b[4] for b in housefield_buckets],
+                                              g=[b[5] for b in housefield_buckets],
+                                              b=[b[6] for b in housefield_buckets]),
+                                         index=table['labels'],
+                                         columns=['average_value', 'color', 'min_value', 'r', 'g', 'b'])
+        return _bucket_frame
+    raise AttributeError("module 'config' has no attribute '{}'".format(name))
+
+
+env_prefix = 'KLC_'
+
+
+def names():
+    """
+    :return: names of all the configuration values
+    """
+    return sorted(n for n, v in globals().items()
+                  if not n.startswith('_') and n != 'env_prefix' and not callable(v)
+                  and not isinstance(v, types.ModuleType))
+
+
+def parse_value(name, value):
+    """
+    Parse an override given as a string, e.g. from the environment or command line.
+    """
+    if not isinstance(value, str):
+        return value
+    if value == 'None':
+        return None
+    if isinstance(globals().get(name), str):
+        # paths etc. stay strings even if they look like numbers
+        return value
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def override(values, export=True):
+    """
+    :param values: dict of name -> value (strings are parsed with parse_value); data_dir moves every data path,
+        and is applied before the other values
+    :param export: also set the KLC_<NAME> environment variables, so that processes started later see the values
+    """
+    global _bucket_table, _bucket_frame
+    unknown = sorted(set(values) - set(names()))
+    if unknown:
+        raise ValueError('unknown config values: {}'.format(', '.join(unknown)))
+    parsed = dict((name, parse_value(name, value)) for name, value in values.items())
+    if 'data_dir' in parsed:
+        set_data_dir(parsed['data_dir'])
+    if 'housefield_buckets' in parsed:
+        _bucket_table, _bucket_frame = None, None
+    for name, value in parsed.items():
+        globals()[name] = value
+        if export:
+            os.environ[env_prefix + name.upper()] = value if isinstance(value, str) else repr(value)
+
+
+def env_overrides(environ=None):
+    """
+    :return: dict of the config values set in the environment as KLC_<NAME>
+    """
+    environ = os.environ if environ is None else environ
+    known = set(names())
+    return dict((key[len(env_prefix):].lower(), value) for key, value in environ.items()
+                if key.startswith(env_prefix) and key[len(env_prefix):].lower() in known)
+
+
+def add_arguments(parser):
+    parser.add_argument('--data_dir', default=None, help='root of the data paths (default {})'.format(data_dir))
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a config value, e.g. --set n_jobs=8; may be repeated')
+
+
+def apply_arguments(args):
+    """
+    Apply the --data_dir / --set arguments added by add_arguments.
+    """
+    values = {}
+    for assignment in args.set:
+        if '=' not in assignment:
+            raise ValueError('--set expects NAME=VALUE, got {!r}'.format(assignment))
+        name, value = assignment.split('=', 1)
+        values[name.strip()] = value
+    if args.data_dir is not None:
+        values['data_dir'] = args.data_dir
+    override(values)
+
+
+def parse_args(argv=None):
+    """
+    For scripts without arguments of their own: apply --data_dir / --set from the command line.
+    :return: the arguments that aren't config overrides
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(parser)
+    args, rest = parser.parse_known_args(argv)
+    apply_arguments(args)
+    return rest
 
 
-housefield_unit_buckets = pd.DataFrame(
-    dict(air=[-1000, '#5080cc', -10000, 170, 200, 240],
-         lung=[-500, 'pink', -750, 238, 136, 186],
-         fat=[-75, 'grey', -150, 150, 150, 150],
-         water=[0, 'blue', -25, 50, 50, 250],
-         # csf=[15, '#90aaff', 5],
-         muscle=[25, 'red', 5, 250, 30, 30],
-         blood=[37.5, 'darkred', 30, 170, 40, 40],
-         liver=[50, 'green', 45, 65, 205, 130],
-         soft_tissue=[200, 'yellow', 75, 220, 200, 50],
-         bone=[700, 'white', 500, 245, 255, 255]),
-    index=['average_value', 'color', 'min_value', 'r', 'g', 'b']
-).transpose().sort_values('min_value')
+override(env_overrides(), export=False)
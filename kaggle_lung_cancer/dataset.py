@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import config, utils, klc_utils, preprocessing, volume_store
+"""
+Training dataset export: the patients' lung crops, normalized once and packed into a few large .npy shards
+(uint8 quantized or float16) plus an index of patient id, label, shard, position and train / validation split.
+Shards are memory mapped, so any sample can be read by index without touching the others.
+"""
+
+
+file_index = 'index.csv'
+file_meta = 'meta.json'
+# zero_center()'s default, applied when dequantizing uint8 shards:
+pixel_mean = .25
+
+
+def is_validation(patient_id, val_fraction=.1):
+    """
+    Deterministic split: depends only on the patient id, so adding or removing patients never moves any
+    other patient between train and validation.
+    """
+    h = int(hashlib.md5(patient_id.encode('utf-8')).hexdigest()[:8], 16)
+    return h % 10000 < val_fraction * 10000
+
+
+def quantize(image, dtype):
+    """
+    :param image: HU volume, or a preprocessing.window_uint8() one
+    :return: uint8: normalize()d values scaled to 0-255; float16: normalize()d and zero_center()ed values
+    """
+    if np.dtype(dtype) == np.uint8:
+        return image if image.dtype == np.uint8 else preprocessing.window_uint8(image)
+    return preprocessing.to_input(image, dtype=dtype)
+
+
+def dequantize(x, dtype, out=None):
+    """
+    Inverse of quantize, to normalized and zero centered values (written into out if given, else float32).
+    """
+    if np.dtype(dtype) == np.uint8:
+        return preprocessing.uint8_to_input(x, out, pixel_mean=pixel_mean)
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    out[...] = x
+    return out
+
+
+def export(patients, labels, out_dir, shard_size=256, dtype=np.uint8, val_fraction=.1):
+    """
+    :param patients: ids of preprocessed patients to export
+    :param labels: stage1 labels DataFrame; unlabelled patients get cancer = -1
+    :param out_dir: directory for the shards, index and meta data
+    :param shard_size: samples per shard
+    :param dtype: np.uint8 or np.float16
+    :return: the index DataFrame
+    """
+    dtype = np.dtype(dtype)
+    shape = (1,) + tuple(config.lung_crop_shape)
+    utils.safe_mkdirs(out_dir)
+    rows = []
+    for shard, start in enumerate(range(0, len(patients), shard_size)):
+        shard_patients = patients[start:start + shard_size]
+        shard_file = 'shard_{:04d}.npy'.format(shard)
+        data = np.lib.format.open_memmap(os.path.join(out_dir, shard_file), mode='w+', dtype=dtype,
+                                         shape=(len(shard_patients),) + shape)
+        for offset, pat in enumerate(shard_patients):
+            volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(pat))
+            data[offset, 0] = quantize(volumes.load(config.file_lungs_cropped), dtype)
+            rows.append(dict(id=pat,
+                             cancer=int(labels.cancer[pat]) if pat in labels.index else -1,
+                             cancer_status=utils.get_patient_cancer_status(patient_id=pat, labels=labels),
+                             shard=shard_file, offset=offset,
+                             split='val' if is_validation(pat, val_fraction) else 'train'))
+        data.flush()
+        del data
+
+    index = pd.DataFrame(rows, columns=['id', 'cancer', 'cancer_status', 'shard', 'offset', 'split'])
+    index.to_csv(os.path.join(out_dir, file_index), index=False)
+    with open(os.path.join(out_dir, file_meta), 'w') as f:
+        json.dump(dict(dtype=dtype.str, shape=list(shape), val_fraction=val_fraction), f)
+    return index
+
+
+class ShardedDataset(object):
+    """
+    Random access to an exported dataset:
+        ds = ShardedDataset('data/dataset/', split='train')
+        x, y = ds[0]
+        x, y = ds.batch([3, 5, 8])
+    """
+
+    def __init__(self, data_dir, split=None, labelled_only=True):
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, file_meta)) as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta['dtype'])
+        self.shape = tuple(meta['shape'])
+        index = pd.read_csv(os.path.join(data_dir, file_index))
+        if split is not None:
+            index = index[index.split == split]
+        if labelled_only:
+            index = index[index.cancer >= 0]
+        self.index = index.reset_index(drop=True)
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, name):
+        if name not in self._shards:
+            self._shards[name] = np.load(os.path.join(self.data_dir, name), mmap_mode='r')
+        return self._shards[name]
+
+    def __getitem__(self, i):
+        x, y = self.batch([i])
+        return x[0], y[0]
+
+    def batch(self, indices):
+        """
+        :return: (x of shape (len(indices),) + shape and dtype config.input_dtype, one hot (benign, cancerous) y)
+        """
+        rows = self.index.iloc[list(indices)]
+        x = np.empty((len(rows),) + self.shape, dtype=config.input_dtype)
+        for i, (shard, offset) in enumerate(zip(rows['shard'], rows['offset'])):
+            dequantize(self.shard(shard)[offset], self.dtype, out=x[i])
+        y = np.zeros((len(rows), 2), dtype=np.float32)
+        y[np.arange(len(rows)), rows['cancer'].values.clip(0, 1)] = 1
+        return x, y
+
+    def batches(self, batch_size=24, shuffle=True, seed=0, loop=True):
+        """
+        Generator of (x, y) batches, e.g. for keras' fit_generator. Shuffled samples are read in shard order
+        within each batch to keep the reads local.
+        """
+        rng = np.random.RandomState(seed)
+        order = np.arange(len(self))
+        while True:
+            if shuffle:
+                rng.shuffle(order)
+            for start in range(0, len(order), batch_size):
+                yield self.batch(np.sort(order[start:start + batch_size]))
+            if not loop:
+                return
+
+
+if __name__ == '__main__':
+    config.parse_args()
+    labels = pd.read_csv(config.input_data_dir + config.file_stage1_labels, index_col='id')
+    patients = klc_utils.complete_patients()
+    index = export(patients, labels, config.dataset_dir)
+    print(index.groupby(['split', 'cancer_status']).size())
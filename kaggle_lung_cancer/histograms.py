@@ -0,0 +1,76 @@
+import numpy as np
+import config, utils, klc_utils, volume_store
+"""
+Hounsfield unit histograms: one count per integer HU value, computed once per patient with np.bincount and stored
+in the patient's volume file, so that patient and cohort histograms can be plotted without reading the volumes.
+"""
+
+
+# counted HU range, values outside it are counted in the first / last bin:
+hu_min = -2048
+hu_max = 4095
+
+
+def hu_counts(pixels, chunk_slices=16):
+    """
+    :param pixels: HU volume (int16)
+    :return: int64 array of hu_max - hu_min + 1 counts, counts[i] = number of voxels with value hu_min + i
+    """
+    n_bins = hu_max - hu_min + 1
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for start in range(0, len(pixels), chunk_slices):
+        # only a chunk of the volume is ever widened to bin indices
+        chunk = np.clip(pixels[start:start + chunk_slices], hu_min, hu_max).astype(np.intp) - hu_min
+        counts += np.bincount(chunk.ravel(), minlength=n_bins)
+    return counts
+
+
+def bin_values():
+    """
+    :return: the HU value of every bin of hu_counts
+    """
+    return np.arange(hu_min, hu_max + 1)
+
+
+def load_hu_counts(volumes):
+    """
+    :param volumes: a patient's volume_store.VolumeFile
+    :return: the stored HU counts, or counted from the resampled pixels for files written without them
+    """
+    if config.file_hu_counts in volumes:
+        return volumes.load(config.file_hu_counts)
+    return hu_counts(volumes[config.file_pixels_resampled].read())
+
+
+def cohort_hu_counts(patients, labels=None):
+    """
+    Sum the HU counts of many patients, only reading their stored counts.
+    :param patients: patient ids
+    :param labels: stage1 labels DataFrame; if given, counts are also summed per cancer status
+    :return: dict of cancer status (and 'all') -> summed counts
+    """
+    totals = {}
+    for pat in patients:
+        volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(pat))
+        counts = load_hu_counts(volumes)
+        groups = ['all']
+        if labels is not None:
+            groups.append(utils.get_patient_cancer_status(patient_id=pat, labels=labels))
+        for g in groups:
+            totals[g] = totals[g] + counts if g in totals else counts.astype(np.int64)
+    return totals
+
+
+def rebin(counts, n_bins=100):
+    """
+    Merge the per HU counts into n_bins equal width bins spanning the values that occur (like a 100 bin
+    histogram of the raw values would).
+    :return: (bin edges in HU, counts per bin)
+    """
+    nonzero = np.flatnonzero(counts)
+    if len(nonzero) == 0:
+        return np.array([hu_min, hu_min + 1.]), np.zeros(1, dtype=np.int64)
+    first, last = nonzero[0], nonzero[-1] + 1
+    edges = np.unique(np.round(np.linspace(first, last, n_bins + 1)).astype(int))
+    binned = np.add.reduceat(counts[first:last], edges[:-1] - first)
+    return edges + hu_min, binned
@@ -1,35 +1,74 @@
 import numpy as np
-import config, utils
+import config, utils, volume_store
 """
 Utils functions that are specific to this pipeline (kaggle lung cancer project)
 """
 
 
+def patient_volume_file(pat):
+    """
+    :return: path of the volume file preprocessing.py saves for a patient
+    """
+    return config.processed_images_dir + pat + '/' + config.file_volumes
+
+
+def complete_patients(images_dir=None):
+    """
+    :param images_dir: folder of patient folders to list, defaults to config.input_images_dir
+    :return: sorted ids of the patients whose volume file is complete
+    """
+    return [pat for pat in utils.list_patients(images_dir or config.input_images_dir)
+            if volume_store.is_complete(patient_volume_file(pat))]
+
+
+def housefield_bucket_lookup():
+    """
+    The Hounsfield unit buckets as numpy arrays (see config.housefield_bucket_table), so that values can be mapped
+    to buckets with np.digitize instead of a lookup per value.
+    :return: dict with the bucket 'edges' (sorted min values), 'labels', 'colors', 'average_values' and an
+        (n_buckets, 3) 'rgb' table
+    """
+    return config.housefield_bucket_table()
+
+
+def housefield_values_to_bucket_idx(values):
+    """
+    A value belongs to the bucket with the largest min_value strictly below it (values below every min_value
+    go into the first bucket).
+    :param values: scalar or array of housefield unit values
+    :return: bucket index (or array of them, same shape as values)
+    """
+    edges = housefield_bucket_lookup()['edges']
+    idx = np.digitize(values, edges, right=True) - 1
+    return np.maximum(idx, 0)
+
+
 def housefield_value_to_label(value):
-    diff = value - config.housefield_unit_buckets.min_value
-    diff = diff[diff>0]
-    label = diff.idxmin()
-    return label
+    return housefield_bucket_lookup()['labels'][housefield_values_to_bucket_idx(value)]
 
 
 def housefield_value_to_color(value):
-    return config.housefield_unit_buckets.color[housefield_value_to_label(value)]
+    return housefield_bucket_lookup()['colors'][housefield_values_to_bucket_idx(value)]
 
 
-def housefield_value_to_rgb(value):
+def housefield_values_to_rgb(values):
+    """
+    Colorize a whole slice or volume in one pass.
+    :param values: array of housefield unit values, any shape
+    :return: float array of shape values.shape + (3,) with rgb values in [0, 1]
+    """
+    values = np.asarray(values)
     # todo replace > near -2000
-    if value < -2000:
-        value = 0
-    if value > 1000:
-        value = 1000
-    value = (value + 2000) /3000
-    label = housefield_value_to_label(value)
-    return [config.housefield_unit_buckets.r[label]/255.,
-            config.housefield_unit_buckets.g[label]/255.,
-            config.housefield_unit_buckets.b[label]/255.]
+    values = np.where(values < -2000, 0, values)
+    idx = housefield_values_to_bucket_idx(np.minimum(values, 1000))
+    return np.take(housefield_bucket_lookup()['rgb'], idx, axis=0)
+
+
+def housefield_value_to_rgb(value):
+    return list(housefield_values_to_rgb(value))
 
 
 def ct_slice_to_3d_rgb_array(slice):
     # starts off as e.g. 355x355 housefield unit values
     # replace values with actual colors:
-    return np.array([[housefield_value_to_rgb(value) for value in col] for col in slice])
+    return housefield_values_to_rgb(slice)
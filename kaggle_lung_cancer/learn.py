@@ -4,16 +4,22 @@ Very simple lung cancer detection based on keras documentation.
 from keras import layers, models
 from keras.utils.np_utils import to_categorical
 import numpy as np
+import loader, dataset
 
 
 
-def test_model_dummy():
+def dummy_model():
     # for a single-input model with 2 classes (binary):
     model = models.Sequential()
     model.add(layers.Dense(1, input_dim=784, activation='sigmoid'))
     model.compile(optimizer='rmsprop',
                   loss='binary_crossentropy',
                   metrics=['accuracy'])
+    return model
+
+
+def test_model_dummy():
+    model = dummy_model()
 
     # generate dummy data
     data = np.random.random((1000, 784))
@@ -24,9 +30,10 @@ def test_model_dummy():
     fit = model.fit(data, labels, nb_epoch=10, batch_size=32)
 
 
-def make_model():
+def lung_model():
+    # 3d convnet on the (1,) + config.lung_crop_shape lung crops, 2 classes (benign, cancerous):
     model = models.Sequential()
-    model.add(layers.Convolution3D(16,1,3,3, input_shape=(1,24,128,128), activation='relu'))
+    model.add(layers.Convolution3D(16,1,3,3, input_shape=loader.input_shape, activation='relu'))
     model.add(layers.Convolution3D(32,1,3,3, activation='relu'))
     model.add(layers.MaxPooling3D(pool_size=(1,2,2)))
     model.add(layers.Convolution3D(32, 1,3,3,  activation='relu'))
@@ -43,5 +50,30 @@ def make_model():
     model.add(layers.Dense(2, activation='softmax'))
     model.compile(loss='categorical_crossentropy',optimizer='adadelta',
                   metrics=['accuracy'])
-    model.fit(trn_x, trn_y, batch_size=24, nb_epoch=10,verbose=1,
-              validation_data=(val_x, val_y))
\ No newline at end of file
+    return model
+
+
+def make_model(batch_size=24, nb_epoch=10, val_fraction=.1, dataset_dir=None, save_path=None, augment=True):
+    if dataset_dir is not None:
+        # batches are read from an exported, pre-normalized dataset, see dataset.py
+        trn, val = dataset.ShardedDataset(dataset_dir, 'train'), dataset.ShardedDataset(dataset_dir, 'val')
+        n_trn, n_val = len(trn), len(val)
+        trn_gen = loader.prefetch(trn.batches(batch_size, shuffle=True), 2)
+        val_gen = loader.prefetch(val.batches(batch_size, shuffle=False), 2)
+    else:
+        # batches are streamed from the preprocessed volumes and the training batches augmented, see loader.py
+        # (exported datasets are already normalized, so they aren't augmented)
+        labels = loader.load_labels()
+        trn_patients, val_patients = loader.train_val_split(loader.labelled_patients(labels), val_fraction)
+        n_trn, n_val = len(trn_patients), len(val_patients)
+        trn_gen = loader.batch_generator(trn_patients, labels, batch_size=batch_size, shuffle=True,
+                                         augment=augment)
+        val_gen = loader.batch_generator(val_patients, labels, batch_size=batch_size, shuffle=False)
+
+    model = lung_model()
+    model.fit_generator(trn_gen, samples_per_epoch=n_trn, nb_epoch=nb_epoch, verbose=1,
+                        validation_data=val_gen, nb_val_samples=n_val)
+    if save_path is not None:
+        # e.g. for score.py
+        model.save(save_path)
+    return model
@@ -0,0 +1,221 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import config, klc_utils, preprocessing, volume_store, augment
+"""
+Streaming training data: batches of preprocessed patients are read (only the cropped sub-cube of each volume),
+optionally augmented (see augment.py), normalized and zero centered on the fly, and prefetched in background
+threads, so the full dataset never has to be in memory.
+"""
+
+
+# (channels, slices, height, width), what learn.make_model expects:
+input_shape = (1,) + tuple(config.lung_crop_shape)
+
+
+def load_labels():
+    return pd.read_csv(config.input_data_dir + config.file_stage1_labels, index_col='id')
+
+
+def labelled_patients(labels):
+    """
+    :return: sorted ids of the patients that have both a label and a finished volume file
+    """
+    patients = [p for p in labels.index
+                if os.path.isfile(klc_utils.patient_volume_file(p))]
+    patients.sort()
+    return patients
+
+
+def crop_window(shape, crop_shape, rng=None):
+    """
+    :param shape: shape of the full volume
+    :param crop_shape: shape wanted. Axes where the volume is smaller are read whole (and padded later).
+    :param rng: np.random.RandomState for a random crop; None for a centered crop
+    :return: tuple of slices to read from the volume
+    """
+    window = []
+    for n, c in zip(shape, crop_shape):
+        if n <= c:
+            start = 0
+        elif rng is None:
+            start = (n - c) // 2
+        else:
+            start = rng.randint(0, n - c + 1)
+        window.append(slice(start, start + min(n, c)))
+    return tuple(window)
+
+
+def pad_to(image, shape, pad_value):
+    # centered padding of any axes that are smaller than shape
+    pad = [((s - n) // 2, s - n - (s - n) // 2) for n, s in zip(image.shape, shape)]
+    if not any(p for p in sum(pad, ())):
+        return image
+    return np.pad(image, pad, mode='constant', constant_values=pad_value)
+
+
+def load_patient_crop(pat, crop_shape=input_shape[1:], rng=None, hu=False, out=None):
+    """
+    Read just the crop_shape sub-cube of a patient's resampled pixels, padded with air where the volume is
+    smaller, then normalize and zero center it.
+    :param hu: return the HU values instead (e.g. to augment them first)
+    :param out: array of shape crop_shape to write the result into, e.g. a slot of a batch
+    :return: array of shape crop_shape, of dtype config.input_dtype (or out's)
+    """
+    volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(pat))
+    pixels = volumes[config.file_pixels_resampled]
+    image = pixels[crop_window(pixels.shape, crop_shape, rng)]
+    image = pad_to(image, crop_shape, pad_value=-1000)
+    if hu:
+        return preprocessing.to_hu(image, out, dtype=config.input_dtype)
+    return preprocessing.to_input(image, out, dtype=config.input_dtype)
+
+
+def load_patient_lungs(pat, hu=False, out=None):
+    """
+    Read the patient's lung crop (made at preprocessing time, already of shape config.lung_crop_shape),
+    then normalize and zero center it.
+    :param hu: return the HU values instead (e.g. to augment them first)
+    :param out: array of shape config.lung_crop_shape to write the result into, e.g. a slot of a batch
+    :return: array of shape config.lung_crop_shape, of dtype config.input_dtype (or out's)
+    """
+    volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(pat))
+    # uint8 (windowed) or int16 (HU), see config.lung_crop_dtype:
+    image = volumes.load(config.file_lungs_cropped)
+    if hu:
+        return preprocessing.to_hu(image, out, dtype=config.input_dtype)
+    return preprocessing.to_input(image, out, dtype=config.input_dtype)
+
+
+def prefetch(iterable, n_batches, poll_seconds=.1):
+    """
+    Run iterable in a background thread, keeping up to n_batches items ready ahead of the consumer.
+    Exceptions raised in the background thread are re-raised in the consumer. Once the consumer stops (it is
+    closed or garbage collected, e.g. after fit_generator is done with an infinite generator), the background
+    thread stops too and closes iterable, instead of blocking on the full queue forever.
+    :param poll_seconds: how often a producer waiting on the full queue checks whether the consumer stopped
+    """
+    q = queue.Queue(maxsize=n_batches)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=poll_seconds)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+        finally:
+            # e.g. shuts down _batches' thread pool
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _batches(patients, labels, batch_size, shuffle, augmented, seed, n_workers, loop, lung_crops):
+    rng = np.random.RandomState(seed)
+    order = np.arange(len(patients))
+    n_classes = 2
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while True:
+            if shuffle:
+                rng.shuffle(order)
+            for start in range(0, len(order), batch_size):
+                idx = order[start:start + batch_size]
+                crop_rngs = [np.random.RandomState(rng.randint(2 ** 31)) if augmented else None for _ in idx]
+                x = np.empty((len(idx),) + input_shape, dtype=config.input_dtype)
+                # augmentation works on float32 HU (scipy.ndimage has no float16); otherwise the patients are
+                # normalized straight into the batch
+                dst = np.empty((len(idx),) + input_shape[1:], dtype=np.float32) if augmented else x[:, 0]
+
+                def load(j, dst=dst, idx=idx, crop_rngs=crop_rngs):
+                    if lung_crops:
+                        load_patient_lungs(patients[idx[j]], hu=augmented, out=dst[j])
+                    else:
+                        load_patient_crop(patients[idx[j]], input_shape[1:], crop_rngs[j], hu=augmented,
+                                          out=dst[j])
+
+                list(pool.map(load, range(len(idx))))
+                if augmented:
+                    augment.augment_batch(dst, rng.randint(2 ** 31), pool)
+                    preprocessing.normalize_center(dst, out=x[:, 0])
+                y = np.zeros((len(idx), n_classes), dtype=np.float32)
+                y[np.arange(len(idx)), labels.cancer[[patients[i] for i in idx]].values.astype(int)] = 1
+                yield x, y
+            if not loop:
+                return
+
+
+def batch_generator(patients, labels, batch_size=24, shuffle=True, augment=False, seed=0,
+                    n_workers=4, n_prefetch=2, loop=True, lung_crops=True):
+    """
+    Generator of (x, y) batches for keras' fit_generator: x has shape (batch,) + input_shape, y is one hot
+    (benign, cancerous). Memory use is bounded by (n_prefetch + 1) batches.
+    :param patients: patient ids to draw from
+    :param labels: stage1 labels DataFrame, see load_labels()
+    :param shuffle: reshuffle the patients every epoch
+    :param augment: augment the batches (see augment.py and the config.augment_* values), and take random
+        sub-cubes instead of centered ones without lung_crops
+    :param seed: seed for shuffling and augmentation; the same seed gives the same batches
+    :param n_workers: threads reading and normalizing the patients of a batch
+    :param n_prefetch: number of batches to prepare ahead of training
+    :param loop: loop over the patients forever, as keras expects
+    :param lung_crops: use the lung crops made at preprocessing time rather than a sub-cube of the full volume
+    """
+    return prefetch(_batches(patients, labels, batch_size, shuffle, augment, seed, n_workers, loop, lung_crops),
+                    n_prefetch)
+
+
+def _unlabelled_batches(patients, batch_size, n_workers, lung_crops):
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for start in range(0, len(patients), batch_size):
+            t = time.time()
+            ids = patients[start:start + batch_size]
+            load = load_patient_lungs if lung_crops else load_patient_crop
+            x = np.empty((len(ids),) + input_shape, dtype=config.input_dtype)
+            list(pool.map(lambda j: load(ids[j], out=x[j, 0]), range(len(ids))))
+            yield ids, x, time.time() - t
+
+
+def prediction_batches(patients, batch_size=24, n_workers=4, n_prefetch=2, lung_crops=True):
+    """
+    Generator of (patient ids, x, seconds spent loading the batch) over patients, in order, once, prefetched in
+    the background like batch_generator.
+    """
+    return prefetch(_unlabelled_batches(patients, batch_size, n_workers, lung_crops), n_prefetch)
+
+
+def train_val_split(patients, val_fraction=.1, seed=0):
+    patients = list(patients)
+    np.random.RandomState(seed).shuffle(patients)
+    n_val = int(round(len(patients) * val_fraction))
+    return sorted(patients[n_val:]), sorted(patients[:n_val])
@@ -0,0 +1,109 @@
+import numpy as np
+"""
+Bit packed binary masks (e.g. the segmented lungs), 8x smaller than the int8 masks segment_lung_mask returns.
+Voxel counts, bounding boxes and set operations all work directly on the packed bytes.
+"""
+
+
+# number of set bits in every possible byte:
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class PackedMask(object):
+    """
+    A 3d binary mask packed along its last axis with np.packbits, so bits has shape (z, y, ceil(x / 8)).
+    The padding bits at the end of each row are always 0.
+    """
+
+    def __init__(self, bits, shape):
+        self.bits = np.asarray(bits, dtype=np.uint8)
+        self.shape = tuple(int(s) for s in shape)
+
+    @classmethod
+    def from_array(cls, mask):
+        mask = np.asarray(mask)
+        return cls(np.packbits(mask != 0, axis=-1), mask.shape)
+
+    def to_array(self, dtype=np.int8):
+        return np.unpackbits(self.bits, axis=-1)[..., :self.shape[-1]].astype(dtype, copy=False)
+
+    def slice(self, i, dtype=np.int8):
+        """
+        :return: unpacked axial slice i (or slices, if i is a slice)
+        """
+        return np.unpackbits(self.bits[i], axis=-1)[..., :self.shape[-1]].astype(dtype, copy=False)
+
+    def contains(self, coords):
+        """
+        :param coords: (n, 3) int voxel coordinates
+        :return: bool array, whether each voxel is in the mask (read straight from the packed bits)
+        """
+        z, y, x = np.asarray(coords, dtype=np.intp).T
+        return ((self.bits[z, y, x >> 3] >> (7 - (x & 7))) & 1).astype(bool)
+
+    def crop(self, box, dtype=np.int8):
+        """
+        :param box: ((z0, z1), (y0, y1), (x0, x1)) half open ranges, e.g. from bounding_box()
+        :return: the unpacked sub-cube, only unpacking the slices it spans
+        """
+        (z0, z1), (y0, y1), (x0, x1) = box
+        return self.slice(slice(z0, z1), dtype=dtype)[:, y0:y1, x0:x1]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError('mask shapes differ: {} vs {}'.format(self.shape, other.shape))
+
+    def union(self, other):
+        self._check(other)
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def intersection(self, other):
+        self._check(other)
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def difference(self, other):
+        """
+        :return: voxels in self but not in other (e.g. filled lungs minus lungs = the filled in lung structures)
+        """
+        self._check(other)
+        return PackedMask(self.bits & ~other.bits, self.shape)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def count(self):
+        """
+        :return: number of voxels in the mask
+        """
+        return int(_popcount[self.bits].sum(dtype=np.int64))
+
+    def bounding_box(self):
+        """
+        :return: ((z0, z1), (y0, y1), (x0, x1)) half open ranges of voxels in the mask, or None if it is empty
+        """
+        if not self.bits.any():
+            return None
+        box = []
+        for axis in range(self.bits.ndim - 1):
+            other_axes = tuple(a for a in range(self.bits.ndim) if a != axis)
+            nonzero = np.flatnonzero(self.bits.any(axis=other_axes))
+            box.append((int(nonzero[0]), int(nonzero[-1]) + 1))
+        # last axis: or all rows together, then only unpack that single row:
+        row = np.bitwise_or.reduce(self.bits.reshape(-1, self.bits.shape[-1]), axis=0)
+        nonzero = np.flatnonzero(np.unpackbits(row)[:self.shape[-1]])
+        box.append((int(nonzero[0]), int(nonzero[-1]) + 1))
+        return tuple(box)
+
+
+def load(volumes, name):
+    """
+    :param volumes: a volume_store.VolumeFile holding name's packed bits, with its unpacked shape in
+        attrs['mask_shapes'][name]
+    :return: the PackedMask stored under name
+    """
+    return PackedMask(volumes.load(name), volumes.attrs['mask_shapes'][name])
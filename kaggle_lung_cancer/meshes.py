@@ -0,0 +1,91 @@
+import os
+import numpy as np
+"""
+Surface meshes of (mask) volumes for the 3d plots: marching cubes on a coarser grid, optional vertex clustering
+decimation, and a compact .npz cache so that plots can be redrawn without recomputing the mesh.
+At 10x10 inches nobody can see the millions of triangles a full 1mm marching cubes makes.
+"""
+
+
+def upright(image):
+    # Position the scan upright,
+    # so the head of the patient would be at the top facing the camera
+    p = image.transpose(2, 1, 0)
+    return p[:, :, ::-1]
+
+
+def downsample(image, factor):
+    """
+    Block max over factor^3 voxel blocks, so thin mask structures don't disappear.
+    """
+    if factor <= 1:
+        return image
+    shape = [n // factor * factor for n in image.shape]
+    image = image[:shape[0], :shape[1], :shape[2]]
+    blocks = image.reshape(shape[0] // factor, factor, shape[1] // factor, factor, shape[2] // factor, factor)
+    return blocks.max(axis=(1, 3, 5))
+
+
+def decimate(verts, faces, cell_size):
+    """
+    Vertex clustering: merge all vertices within the same cell_size^3 grid cell into their mean, then drop the
+    faces that collapsed and duplicates.
+    """
+    cells = np.floor(verts / cell_size).astype(np.int64)
+    _, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    n = inverse.max() + 1
+    counts = np.bincount(inverse, minlength=n).astype(np.float64)
+    new_verts = np.stack([np.bincount(inverse, weights=verts[:, a], minlength=n) for a in range(3)], axis=1)
+    new_verts /= counts[:, None]
+
+    faces = inverse[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[keep]
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return new_verts.astype(np.float32), faces[np.sort(first)]
+
+
+def make_mesh(image, level=0, step_size=1, downsample_factor=1, decimate_cell=None):
+    """
+    :param image: volume (slices, rows, columns), e.g. a lung mask
+    :param level: iso value of the surface
+    :param step_size: marching cubes step size in (downsampled) voxels
+    :param downsample_factor: block max downsampling before marching cubes
+    :param decimate_cell: if given, cluster vertices on a grid of this size (in voxels of image)
+    :return: dict(verts=(n, 3) float32, faces=(m, 3) int32, shape=shape of the upright volume)
+    """
+    # skimage is only imported if a mesh has to be made (cached meshes don't need it)
+    from skimage import measure
+    p = upright(image)
+    small = downsample(p, downsample_factor)
+    verts, faces = measure.marching_cubes(small, level, step_size=step_size)[:2]
+    verts = verts * downsample_factor
+    if decimate_cell:
+        verts, faces = decimate(verts, faces, decimate_cell)
+    return dict(verts=verts.astype(np.float32), faces=faces.astype(np.int32), shape=np.array(p.shape))
+
+
+def save_mesh(path, mesh):
+    tmp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')] if path.endswith('.npz') else path, os.getpid())
+    np.savez_compressed(tmp_path, **mesh)
+    os.replace(tmp_path, path)
+
+
+def load_mesh(path):
+    with np.load(path) as f:
+        return dict((k, f[k]) for k in f.files)
+
+
+def cached_mesh(path, image_fn, input_mtime=None, **kwargs):
+    """
+    :param path: .npz file the mesh is cached in
+    :param image_fn: function returning the volume, only called if the mesh has to be (re)made
+    :param input_mtime: modification time of the data the volume comes from; older caches are remade
+    :param kwargs: make_mesh arguments
+    """
+    if os.path.isfile(path) and (input_mtime is None or os.path.getmtime(path) >= input_mtime):
+        return load_mesh(path)
+    mesh = make_mesh(image_fn(), **kwargs)
+    save_mesh(path, mesh)
+    return mesh
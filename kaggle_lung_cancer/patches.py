@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+from scipy.spatial import cKDTree
+import config, utils, klc_utils, volume_store, masks, components
+"""
+Patch extraction: fixed shape patches sampled only inside the lungs, either on a sliding window grid or around
+nodule candidates (dense blobs inside the lung mask). Only patch centers are stored (a small .npz per patient);
+patches are read lazily from the memory mapped volumes, and a k-d tree over the centers answers spatial queries
+(patches near a point, patches in a box).
+"""
+
+
+# kinds of patches:
+WINDOW = 0
+CANDIDATE = 1
+
+
+def window_centers(lung_mask, patch_shape, stride):
+    """
+    Centers of a sliding window grid, keeping only those that fall inside the lung mask.
+    :param lung_mask: masks.PackedMask
+    :param patch_shape: (depth, height, width)
+    :param stride: (z, y, x) step of the grid
+    :return: (n, 3) int array of centers
+    """
+    axes = [np.arange(min(p // 2, n - 1), n, s) for n, p, s in zip(lung_mask.shape, patch_shape, stride)]
+    grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    return grid[lung_mask.contains(grid)]
+
+
+def detect_candidates(pixels, lung_mask, threshold=-400, min_voxels=10, max_voxels=30000, smooth=1.):
+    """
+    Nodule candidates: connected blobs of voxels denser than threshold HU inside the lungs.
+    :param pixels: resampled HU volume (array or volume_store.Volume, of which only the lungs' box is read)
+    :param lung_mask: masks.PackedMask of the (filled) lungs
+    :param smooth: sigma (voxels) of a gaussian applied first, to merge noisy blobs; 0 to skip
+    :param min_voxels: smaller blobs are dropped (noise, small vessels)
+    :param max_voxels: larger blobs are dropped (vessel trees, the lung wall)
+    :return: DataFrame with z, y, x (centroid), voxels and the blob's bounding box, largest first
+    """
+    box = lung_mask.bounding_box()
+    if box is None:
+        return pd.DataFrame(columns=['z', 'y', 'x', 'voxels', 'z0', 'z1', 'y0', 'y1', 'x0', 'x1'])
+    # only look inside the lungs' bounding box
+    region = pixels[tuple(slice(lo, hi) for lo, hi in box)].astype(np.float32)
+    if smooth:
+        region = scipy.ndimage.gaussian_filter(region, smooth)
+    dense = (region > threshold) & (lung_mask.crop(box) != 0)
+    labels, _ = scipy.ndimage.label(dense)
+    stats = components.component_stats(labels, bg=0)
+
+    keep = (stats['sizes'] >= min_voxels) & (stats['sizes'] <= max_voxels)
+    offset = np.array([lo for lo, hi in box])
+    centroids = stats['centroids'][keep] + offset
+    bboxes = stats['bboxes'][keep] + offset[:, None]
+    return pd.DataFrame(dict(z=centroids[:, 0], y=centroids[:, 1], x=centroids[:, 2], voxels=stats['sizes'][keep],
+                             z0=bboxes[:, 0, 0], z1=bboxes[:, 0, 1], y0=bboxes[:, 1, 0], y1=bboxes[:, 1, 1],
+                             x0=bboxes[:, 2, 0], x1=bboxes[:, 2, 1]),
+                        columns=['z', 'y', 'x', 'voxels', 'z0', 'z1', 'y0', 'y1', 'x0', 'x1'])
+
+
+def read_patch(volume, center, patch_shape, pad_value=-1000):
+    """
+    Read the patch_shape sub-cube centered on center, padding with pad_value where it sticks out of the volume.
+    :param volume: volume_store.Volume (only the needed slices are read) or array
+    """
+    start = [int(c) - p // 2 for c, p in zip(center, patch_shape)]
+    src = tuple(slice(max(s, 0), min(s + p, n)) for s, p, n in zip(start, patch_shape, volume.shape))
+    dst = tuple(slice(sl.start - s, sl.stop - s) for sl, s in zip(src, start))
+    patch = np.full(patch_shape, pad_value, dtype=volume.dtype)
+    patch[dst] = volume[src]
+    return patch
+
+
+class PatchIndex(object):
+    """
+    A patient's patch centers with a k-d tree over them. Patches are read lazily from the patient's volume file.
+    """
+
+    def __init__(self, pat, centers, kinds, patch_shape):
+        self.pat = pat
+        self.centers = np.asarray(centers, dtype=np.int32).reshape(-1, 3)
+        self.kinds = np.asarray(kinds, dtype=np.int8)
+        self.patch_shape = tuple(int(p) for p in patch_shape)
+        self._tree = None
+        self._volume = None
+
+    def __len__(self):
+        return len(self.centers)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.centers)
+        return self._tree
+
+    def near(self, point, radius):
+        """
+        :return: indices of the patches centered within radius voxels of point
+        """
+        return np.array(sorted(self.tree.query_ball_point(point, radius)), dtype=np.intp)
+
+    def nearest(self, point, k=1):
+        distances, idx = self.tree.query(point, k=k)
+        return np.atleast_1d(idx)
+
+    def in_box(self, box):
+        """
+        :param box: ((z0, z1), (y0, y1), (x0, x1)) half open ranges
+        :return: indices of the patches centered inside box
+        """
+        lo = np.array([b[0] for b in box])
+        hi = np.array([b[1] for b in box])
+        return np.flatnonzero(np.all((self.centers >= lo) & (self.centers < hi), axis=1))
+
+    def volume(self):
+        if self._volume is None:
+            volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(self.pat))
+            self._volume = volumes[config.file_pixels_resampled]
+        return self._volume
+
+    def patch(self, i):
+        return read_patch(self.volume(), self.centers[i], self.patch_shape)
+
+    def save(self, path):
+        np.savez(path, centers=self.centers, kinds=self.kinds, patch_shape=np.array(self.patch_shape))
+
+    @classmethod
+    def load(cls, pat, path=None):
+        with np.load(path or patient_patch_file(pat)) as f:
+            return cls(pat, f['centers'], f['kinds'], f['patch_shape'])
+
+
+def patient_patch_file(pat):
+    return config.processed_images_dir + pat + '/' + config.file_patches
+
+
+def extract_patient(pat, patch_shape=None, stride=None):
+    """
+    Find the window and candidate patch centers of a patient and save them as a PatchIndex.
+    :return: (patient id, number of window patches, number of candidate patches)
+    """
+    patch_shape = tuple(patch_shape or config.patch_shape)
+    stride = tuple(stride or config.patch_stride)
+    volumes = volume_store.VolumeFile(klc_utils.patient_volume_file(pat))
+    lungs = masks.load(volumes, config.file_segmented_lungs_fill)
+    windows = window_centers(lungs, patch_shape, stride)
+    candidates = detect_candidates(volumes[config.file_pixels_resampled], lungs,
+                                   threshold=config.candidate_threshold)
+    candidate_centers = np.round(candidates[['z', 'y', 'x']].values).astype(np.int32)
+    index = PatchIndex(pat, np.concatenate([windows, candidate_centers]),
+                       np.concatenate([np.full(len(windows), WINDOW), np.full(len(candidates), CANDIDATE)]),
+                       patch_shape)
+    index.save(patient_patch_file(pat))
+    return pat, len(windows), len(candidates)
+
+
+def main(n_jobs=None):
+    patients = klc_utils.complete_patients()
+    results = utils.run_pool(extract_patient, [(pat,) for pat in patients], n_jobs or config.n_jobs)
+    for i, (pat, n_windows, n_candidates) in enumerate(results):
+        print('Patient {}/{}: {}: {} window and {} candidate patches'.format(
+            i + 1, len(patients), pat, n_windows, n_candidates))
+
+
+if __name__ == '__main__':
+    # NOTE: must be run after preprocessing.py has been run at least once!
+    config.parse_args()
+    main()
@@ -1,6 +1,20 @@
-import config, preprocessing, plots, utils
+import os
+import config
 
-# run the whole pipeline:
+# e.g. python pipeline.py --data_dir /mnt/kaggle/ --set n_jobs=8 (see config.py)
+config.parse_args()
+
+# run the whole pipeline; each stage's modules (and their dependencies) are only imported when it runs:
+import preprocessing
 preprocessing.main()
+import plots
 plots.main()
 
+# where did the time go (see profiling.py):
+if config.profile_log and os.path.isfile(config.profile_log):
+    import pandas as pd
+    import profiling
+    pd.set_option('display.width', 200)
+    report = profiling.summary()
+    print(report)
+    report.to_csv(os.path.splitext(config.profile_log)[0] + '_summary.csv')
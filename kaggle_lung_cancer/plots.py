@@ -1,108 +1,166 @@
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.patches as mpatches
-from skimage import measure, morphology
+from PIL import Image
 import base64
 # from IPython.display import HTML
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 import numpy as np  # linear algebra
 import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
 import os
-import config, utils, klc_utils
+import time
+import config, utils, klc_utils, volume_store, masks, histograms, meshes, profiling
 
 
-# todo create or find a plot save wrapper / decorator?
+def new_figure(figsize=None):
+    """
+    A figure that isn't registered with pyplot (so nothing has to remember to plt.close it), drawn with Agg.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
 
 
-def plot_3d(image, threshold=-300, save_path=None, cancer_status=''):
-    # Position the scan upright,
-    # so the head of the patient would be at the top facing the camera
-    p = image.transpose(2, 1, 0)
-    p = p[:, :, ::-1]
-
-    verts, faces = measure.marching_cubes(p, threshold)
-
-    fig = plt.figure(figsize=(10, 10))
+def save_figure(fig, save_path):
+    """
+    Save fig to save_path if given, else return it (e.g. for display in a notebook).
+    """
+    if save_path is not None:
+        fig.savefig(save_path)
+        return None
+    return fig
+
+
+def plot_3d(image, threshold=-300, save_path=None, cancer_status='', mesh=None):
+    """
+    :param image: volume to draw the threshold surface of; not needed if mesh is given
+    :param mesh: precomputed (e.g. cached) mesh, see meshes.py. By default it is made with the config.mesh_*
+        settings.
+    """
+    if mesh is None:
+        mesh = meshes.make_mesh(image, threshold, step_size=config.mesh_step_size,
+                                downsample_factor=config.mesh_downsample, decimate_cell=config.mesh_decimate_cell)
+    verts, faces, shape = mesh['verts'], mesh['faces'], mesh['shape']
+    # only imported (registering the 3d projection) when a 3d plot is drawn
+    from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+
+    fig = new_figure(figsize=(10, 10))
     ax = fig.add_subplot(111, projection='3d')
 
     # Fancy indexing: `verts[faces]` to generate a collection of triangles
-    mesh = Poly3DCollection(verts[faces], alpha=0.1)
+    collection = Poly3DCollection(verts[faces], alpha=0.1)
     face_color = [0.5, 0.5, 1]
-    mesh.set_facecolor(face_color)
-    ax.add_collection3d(mesh)
-
-    ax.set_xlim(0, p.shape[0])
-    ax.set_ylim(0, p.shape[1])
-    ax.set_zlim(0, p.shape[2])
-    plt.title("Cancer Status: {}".format(cancer_status))
-
-    if save_path is not None:
-        plt.savefig(save_path)
-        plt.close()
-    else:
-        plt.show()
-
-
-def plot_housefield_units_hist(patient_pixels, save_path=None, cancer_status=''):
-    # p has 2 elements: 1) frequency and 2) bin start / ends.
-    series = pd.Series(patient_pixels.flatten())
-    freq, bins = np.histogram(series, config.housefield_unit_buckets.min_value)
-
-    p = series.plot(kind='hist', bins=100, color='#5090cc')
-    for i, rectangle in enumerate(p.patches):  # iterate over every bar
-        distances = abs((rectangle.get_x() + (rectangle.get_width() * .5)) -
-                        config.housefield_unit_buckets.average_value)
-        closest = distances.idxmin()
-        p.patches[i].set_color(config.housefield_unit_buckets.color[closest])
-        p.patches[i].set_label(closest)
-
-    handles, labels = p.get_legend_handles_labels()
-    fuck_python_plotting_idx = ~pd.Series(labels).duplicated().values
-    h = [handles[i] for i in range(len(handles)) if fuck_python_plotting_idx[i] == True]
-    l = [labels[i] for i in range(len(labels)) if fuck_python_plotting_idx[i] == True]
-    p.legend(h, l)
-    plt.xlabel("Hounsfield Units (HU)")
-    plt.ylabel("Frequency")
-    plt.title("Cancer Status: {}".format(cancer_status))
-
-    if save_path is not None:
-        plt.savefig(save_path)
-        plt.close()
-    else:
-        plt.show()
-        plt.close()
+    collection.set_facecolor(face_color)
+    ax.add_collection3d(collection)
+
+    ax.set_xlim(0, shape[0])
+    ax.set_ylim(0, shape[1])
+    ax.set_zlim(0, shape[2])
+    ax.set_title("Cancer Status: {}".format(cancer_status))
+
+    return save_figure(fig, save_path)
+
+
+def patient_mesh(pat, name, image_fn, threshold, input_mtime):
+    """
+    The patient's mesh of image_fn() at threshold, cached next to their preprocessed volumes.
+    """
+    path = config.processed_images_dir + pat + '/mesh_{}_{}_{}_{}_{}.npz'.format(
+        name, threshold, config.mesh_step_size, config.mesh_downsample, config.mesh_decimate_cell)
+    return meshes.cached_mesh(path, image_fn, input_mtime=input_mtime, level=threshold,
+                              step_size=config.mesh_step_size, downsample_factor=config.mesh_downsample,
+                              decimate_cell=config.mesh_decimate_cell)
+
+
+def plot_housefield_units_hist(patient_pixels=None, save_path=None, cancer_status='', counts=None, title=None):
+    """
+    :param patient_pixels: HU volume, only used if counts isn't given
+    :param counts: per HU counts (see histograms.py), e.g. stored with the patient or summed over a cohort
+    :param title: defaults to the cancer status
+    """
+    if counts is None:
+        counts = histograms.hu_counts(patient_pixels)
+    edges, freq = histograms.rebin(counts, n_bins=100)
+    centers = (edges[:-1] + edges[1:]) * .5
+    widths = np.diff(edges)
+
+    # colour every bar by the bucket whose average value is closest to the bar's center:
+    hus = config.housefield_bucket_table()
+    closest = np.abs(centers[:, None] - hus['average_values'][None, :]).argmin(axis=1)
+
+    fig = new_figure()
+    ax = fig.add_subplot(111)
+    for b in np.unique(closest):
+        bars = closest == b
+        ax.bar(centers[bars], freq[bars], width=widths[bars], color=hus['colors'][b], label=hus['labels'][b])
+    ax.legend()
+    ax.set_xlabel("Hounsfield Units (HU)")
+    ax.set_ylabel("Frequency")
+    ax.set_title(title or "Cancer Status: {}".format(cancer_status))
+
+    return save_figure(fig, save_path)
 
 
 def plot_ct_slice(patient_pixels, slice_idx=80, save_path=None, cancer_status='', color=True):
     # Show some slice in the middle
     slice = patient_pixels[slice_idx]
+    fig = new_figure()
+    ax = fig.add_subplot(111)
     if color:
         slice = klc_utils.ct_slice_to_3d_rgb_array(slice)
-        p = plt.imshow(slice)
+        ax.imshow(slice)
     else:
-        p = plt.imshow(slice, cmap=plt.cm.gray)
-
-    hus = config.housefield_unit_buckets
-    colors = [mpatches.Patch(color=hus.color[l], label='{} ({})'.format(l, hus.average_value[l])) for l in hus.index]
-    plt.legend(handles=colors)
-    plt.title("CT Slice ({})\nCancer Status: {}".format(slice_idx, cancer_status))
-    if save_path is not None:
-        plt.savefig(save_path)
-        plt.close()
+        ax.imshow(slice, cmap=cm.gray)
+
+    colors = [mpatches.Patch(color=color, label='{} ({})'.format(label, average_value))
+              for label, average_value, color in (b[:3] for b in config.housefield_buckets)]
+    ax.legend(handles=colors)
+    ax.set_title("CT Slice ({})\nCancer Status: {}".format(slice_idx, cancer_status))
+    return save_figure(fig, save_path)
+
+
+def ct_scan_frames(pixels, stride=1, downscale=1, window=None):
+    """
+    Turn a HU volume into 8 bit frames in one vectorized pass.
+    :param stride: only keep every stride-th slice
+    :param downscale: only keep every downscale-th row and column
+    :param window: (min HU, max HU) mapped to 0 and 255, defaults to the volume's range
+    :return: uint8 array (frames, rows, columns)
+    """
+    frames = pixels[::stride, ::downscale, ::downscale]
+    lo, hi = window if window is not None else (frames.min(), frames.max())
+    frames = (frames.astype(np.float32) - lo) * (255. / max(hi - lo, 1))
+    return np.clip(frames, 0, 255, out=frames).astype(np.uint8)
+
+
+def colormap_lut(cmap=cm.bone):
+    """
+    :return: (256, 3) uint8 rgb lookup table of cmap
+    """
+    return (cmap(np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def animate_ct_scan(pixels, gifname, stride=1, downscale=1, window=None, frame_ms=50):
+    """
+    Write the scan as an animation, one frame per (stride-th) slice, coloured with cm.bone.
+    Frames are encoded in process: GIFs with PIL (the frames are the palette indices, so nothing is quantized),
+    anything else (e.g. .mp4) with imageio, which needs imageio-ffmpeg.
+    """
+    frames = ct_scan_frames(pixels, stride=stride, downscale=downscale, window=window)
+    lut = colormap_lut(cm.bone)
+    if gifname.lower().endswith('.gif'):
+        palette = lut.ravel().tolist()
+        images = []
+        for frame in frames:
+            image = Image.fromarray(frame, mode='P')
+            image.putpalette(palette)
+            images.append(image)
+        images[0].save(gifname, save_all=True, append_images=images[1:], duration=frame_ms, loop=0)
     else:
-        plt.show()
-
-
-def animate_ct_scan(pixels, gifname):
-    # Based on @Zombie's code
-    fig = plt.figure()
-    anim = plt.imshow(pixels[0], cmap=plt.cm.bone)
-    def update(i):
-        anim.set_array(pixels[i])
-        return anim,
-
-    a = animation.FuncAnimation(fig, update, frames=range(len(pixels)), interval=50, blit=True)
-    a.save(gifname, writer='imagemagick')
+        import imageio
+        imageio.mimwrite(gifname, lut[frames], fps=1000. / frame_ms)
 
 
 # def display_gif(fname):
@@ -112,76 +170,113 @@ def animate_ct_scan(pixels, gifname):
 #     return HTML(IMG_TAG.format(data))
 
 
-def main():
+def is_stale(output, input_mtime):
+    # an output has to be (re)made if it doesn't exist or is older than the data it is plotted from
+    return not os.path.isfile(output) or os.path.getmtime(output) < input_mtime
+
+
+def plot_patient(pat, cancer_status):
+    """
+    Make every plot of a patient that is missing or older than the patient's preprocessed volumes.
+    Runs in a worker process.
+    :return: (patient id, list of (plot type, seconds) for the plots made)
+    """
+    profiling.set_patient(pat)
+    volume_file = klc_utils.patient_volume_file(pat)
+    input_mtime = os.path.getmtime(volume_file)
+    volumes = volume_store.VolumeFile(volume_file)
+    # first make folder to store patient plots:
+    plot_file = config.plots_dir + '{}' + cancer_status + '_' + pat + '.jpeg'
+    n_slices = volumes[config.file_pixels_resampled].shape[0]
+
+    # (plot type, plots dir, output file, function making the plot into that file)
+    jobs = []
+    jobs.append(('ct_scan_gif', 'ct_scan_gif/', plot_file.format('ct_scan_gif/').replace('.jpeg', '.gif'),
+                 lambda pixels, path: animate_ct_scan(pixels(), gifname=path,
+                                                     stride=config.gif_stride, downscale=config.gif_downscale)))
+    jobs.append(('housefield_unit_histogram', 'housefield_unit_histograms/',
+                 plot_file.format('housefield_unit_histograms/'),
+                 lambda pixels, path: plot_housefield_units_hist(counts=histograms.load_hu_counts(volumes),
+                                                                 save_path=path, cancer_status=cancer_status)))
+    for slice in range(0, n_slices, 30):
+        for color in [True, False]:
+            dir = 'ct_slices_{}_{}/'.format('rgb' if color else 'bw', slice)
+            jobs.append(('ct_slice_' + ('rgb' if color else 'bw'), dir, plot_file.format(dir),
+                         lambda pixels, path, slice=slice, color=color: plot_ct_slice(
+                             patient_pixels=pixels(), slice_idx=slice, save_path=path,
+                             cancer_status=cancer_status, color=color)))
+
+    def lungs_fill():
+        return masks.load(volumes, config.file_segmented_lungs_fill)
+
+    jobs.append(('segmented_lungs', 'segmented_lungs/', plot_file.format('segmented_lungs/'),
+                 lambda pixels, path: plot_3d(None, save_path=path, cancer_status=cancer_status, mesh=patient_mesh(
+                     pat, 'segmented_lungs_structures',
+                     lambda: (lungs_fill() - masks.load(volumes, config.file_segmented_lungs)).to_array(), 0,
+                     input_mtime))))
+    jobs.append(('segmented_lungs_filled', 'segmented_lungs_filled/', plot_file.format('segmented_lungs_filled/'),
+                 lambda pixels, path: plot_3d(None, save_path=path, cancer_status=cancer_status, mesh=patient_mesh(
+                     pat, config.file_segmented_lungs_fill, lambda: lungs_fill().to_array(), 0, input_mtime))))
+
+    # only read the pixels if some plot needs them (memory mapped unless the volumes are compressed)
+    loaded = []
+
+    def pixels():
+        if not loaded:
+            loaded.append(volumes.load(config.file_pixels_resampled))
+        return loaded[0]
+
+    timings = []
+    for plot_type, dir, path, make_plot in jobs:
+        if not is_stale(path, input_mtime):
+            continue
+        utils.safe_mkdirs(config.plots_dir + dir)
+        start = time.time()
+        try:
+            with profiling.stage('plot_' + plot_type):
+                make_plot(pixels, path)
+        except Exception as e:
+            # e.g. marching cubes finds no surface in an empty mask; don't lose the patient's other plots
+            print('\tfailed to plot {}: {!r}'.format(path, e))
+            continue
+        timings.append((plot_type, time.time() - start))
+    return pat, timings
+
+
+def timings_report(timings):
+    """
+    :param timings: list of (plot type, seconds)
+    :return: per plot type count, total and mean seconds, slowest first, as a DataFrame
+    """
+    df = pd.DataFrame(timings, columns=['plot_type', 'seconds'])
+    report = df.groupby('plot_type').seconds.agg(['count', 'sum', 'mean'])
+    return report.sort_values('sum', ascending=False)
+
+
+def main(n_jobs=None):
+    # Patients are spread over a process pool; plots that are already up to date are skipped.
     labels = pd.read_csv(config.input_data_dir + config.file_stage1_labels, index_col='id')
-    patients = os.listdir(config.input_images_dir)
-    patients.sort()
-    utils.safe_mkdirs(config.processed_images_dir)
+    patients = klc_utils.complete_patients()
     utils.safe_mkdirs(config.plots_dir)
-    for p in range(len(patients)):
-        pat = patients[p]
-        if pat != '.DS_Store':
-
-            cancer_status = utils.get_patient_cancer_status(patient_id=pat, labels=labels)
-            patient_proc_data_dir = config.processed_images_dir + pat + '/'
-
-            print('Creating plots for patient {}/{}: {}'.format(p + 1, len(patients), pat))
-            print('\tCancer status: {}'.format(cancer_status))
-            print('\tSaving plots to {}'.format(patient_proc_data_dir))
-            # load objects
-            patient_data_file = patient_proc_data_dir + '{}.npy'
-            # scan = np.load(file=patient_data_file.format(config.file_scan))
-            pixels = np.load(file=patient_data_file.format(config.file_pixels_resampled))
-            # pix = np.load(file=patient_data_file.format(config.file_pixels))
-            spacing = np.load(file=patient_data_file.format(config.file_pixels_resampled_spacing))
-            segmented_lungs = np.load(file=patient_data_file.format(config.file_segmented_lungs))
-            segmented_lungs_fill = np.load(file=patient_data_file.format(config.file_segmented_lungs_fill))
-
-            # now make some initial plots:
-            # first make folder to store patient plots:
-            plot_file = config.plots_dir + '{}' + cancer_status + '_' + pat + '.jpeg'
-
-            dir = 'ct_scan_gif/'
-            utils.safe_mkdirs(config.plots_dir + dir)
-            filepath = plot_file.format(dir).replace('.jpeg', '.gif')
-            print('\t\tplotting: '+filepath)
-            animate_ct_scan(pixels, gifname=filepath)
-
-
-            dir = 'housefield_unit_histograms/'
-            utils.safe_mkdirs(config.plots_dir + dir)
-            print('\t\tplotting: '+plot_file.format(dir))
-            plot_housefield_units_hist(patient_pixels=pixels,
-                                       save_path=plot_file.format(dir),
-                                       cancer_status=cancer_status)
-
-
-            for slice in range(0, len(pixels), 30):
-                for color in [True, False]:
-                    colored = 'rgb' if color else 'bw'
-                    dir = 'ct_slices_{}_{}/'.format(colored, slice)
-                    utils.safe_mkdirs(config.plots_dir + dir)
-                    if slice < len(pixels):
-                        print('\t\tplotting: '+plot_file.format(dir))
-                        plot_ct_slice(patient_pixels=pixels,
-                                      slice_idx=slice,
-                                      save_path=plot_file.format(dir),
-                                      cancer_status=cancer_status,
-                                      color=color)
-
-            dir = 'segmented_lungs/'
-            utils.safe_mkdirs(config.plots_dir + dir)
-            plot_3d(segmented_lungs_fill - segmented_lungs, 0,
-                    save_path=plot_file.format(dir),
-                    cancer_status=cancer_status)
-
-            dir = 'segmented_lungs_filled/'
-            utils.safe_mkdirs(config.plots_dir + dir)
-            plot_3d(segmented_lungs_fill, 0,
-                    save_path=plot_file.format(dir),
-                    cancer_status=cancer_status)
+    jobs = [(pat, utils.get_patient_cancer_status(patient_id=pat, labels=labels)) for pat in patients]
+
+    timings = []
+    for i, (pat, patient_timings) in enumerate(utils.run_pool(plot_patient, jobs, n_jobs or config.n_jobs)):
+        print('Created {} plots for patient {}/{}: {}'.format(len(patient_timings), i + 1, len(jobs), pat))
+        timings.extend(patient_timings)
+
+    if timings:
+        print(timings_report(timings))
+
+    # cohort wide histograms, from the counts stored with every patient:
+    dir = 'cohort_housefield_unit_histograms/'
+    utils.safe_mkdirs(config.plots_dir + dir)
+    for group, counts in sorted(histograms.cohort_hu_counts(patients, labels).items()):
+        plot_housefield_units_hist(counts=counts, save_path=config.plots_dir + dir + group + '.jpeg',
+                                   title='Cohort: {} patients'.format(group))
 
 
 if __name__ == '__main__':
     # NOTE: must be run after preprocessing.py has been run at least once!
+    config.parse_args()
     main()
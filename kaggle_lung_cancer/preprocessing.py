@@ -1,11 +1,8 @@
 import numpy as np  # linear algebra
 import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
-import dicom
 import os
-import scipy.ndimage
-from skimage import measure, morphology
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
-import config, utils
+from concurrent.futures import ThreadPoolExecutor
+import config, utils, klc_utils, volume_store, masks, resampling, components, stage_cache, histograms, profiling
 
 """
 Note: much of the code in this file is based off of the awesome Guido's Zuidhof's pre-processing tutorial
@@ -15,8 +12,16 @@ https://www.kaggle.com/gzuidhof/data-science-bowl-2017/full-preprocessing-tutori
 
 
 # Load the scans in given folder path
-def load_scan(path):
-    slices = [dicom.read_file(path + '/' + s) for s in os.listdir(path)]
+def load_scan(path, headers_only=False):
+    """
+    :param path: folder holding one patient's DICOM files
+    :param headers_only: only read the DICOM headers (stop before the pixel data); get_pixels_hu then reads the
+        pixel data of each slice itself, straight into the output volume.
+    :return: slices sorted by InstanceNumber, each with its SliceThickness set
+    """
+    # dicom (and skimage, below) are only imported by the stages that use them, e.g. not by the training loader
+    import dicom
+    slices = [dicom.read_file(path + '/' + s, stop_before_pixels=headers_only) for s in os.listdir(path)]
     slices.sort(key=lambda x: int(x.InstanceNumber))
     try:
         slice_thickness = np.abs(slices[0].ImagePositionPatient[2] - slices[1].ImagePositionPatient[2])
@@ -29,30 +34,73 @@ def load_scan(path):
     return slices
 
 
-def get_pixels_hu(scans):
-    image = np.stack([s.pixel_array for s in scans])
-    # Convert to int16 (from sometimes int16),
-    # should be possible as values should always be low enough (<32k)
-    image = image.astype(np.int16)
+def slice_pixel_array(s):
+    # slices loaded with headers_only=True don't hold their pixel data yet
+    if 'PixelData' in s:
+        return s.pixel_array
+    import dicom
+    return dicom.read_file(s.filename).pixel_array
+
+
+def get_pixels_hu(scans, n_threads=1, dtype=np.int16):
+    """
+    Decode the slices (in n_threads threads) directly into one preallocated volume and convert it to
+    Hounsfield units in place, using each slice's own RescaleSlope / RescaleIntercept.
+    :param dtype: np.int16, or np.float32 to get the (unrounded) HU values ready for training
+    """
+    dtype = np.dtype(dtype)
+    image = np.empty((len(scans), int(scans[0].Rows), int(scans[0].Columns)), dtype=dtype)
+
+    def decode(i):
+        # Convert to int16 (from sometimes int16),
+        # should be possible as values should always be low enough (<32k)
+        image[i] = slice_pixel_array(scans[i])
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(decode, range(len(scans))))
+    else:
+        for i in range(len(scans)):
+            decode(i)
 
     # Set outside-of-scan pixels to 0
     # The intercept is usually -1024, so air is approximately 0
     image[image == -2000] = 0
 
-    # Convert to Hounsfield units (HU)
-    intercept = scans[0].RescaleIntercept
-    slope = scans[0].RescaleSlope
+    # Convert to Hounsfield units (HU), broadcasting each slice's slope and intercept over the slice
+    slopes = np.array([float(s.RescaleSlope) for s in scans], dtype=np.float32)[:, None, None]
+    intercepts = np.array([float(s.RescaleIntercept) for s in scans], dtype=np.float32)[:, None, None]
+
+    if dtype == np.float32:
+        image *= slopes
+        image += intercepts
+        return image
 
-    if slope != 1:
-        image = slope * image.astype(np.float64)
-        image = image.astype(np.int16)
+    # float64 multiply (float32 is off by one HU for some values, e.g. float32(0.7) * 10 = 6.9999998), truncated
+    # back into the int16 buffer one slice at a time, so the float64 temporary is only a slice
+    for i, s in enumerate(scans):
+        slope = float(s.RescaleSlope)
+        if slope != 1:
+            np.multiply(image[i], slope, out=image[i], dtype=np.float64, casting='unsafe')
 
-    image += np.int16(intercept)
+    image += intercepts.astype(np.int16)
 
-    return np.array(image, dtype=np.int16)
+    return image
+
+
+def scan_spacing(scan):
+    """
+    :param scan: the slices from load_scan (or an already known spacing)
+    :return: (z, y, x) spacing in mm
+    """
+    if hasattr(scan[0], 'PixelSpacing'):
+        spacing = map(float, ([scan[0].SliceThickness] + list(scan[0].PixelSpacing)))
+    else:
+        spacing = map(float, scan)
+    return np.array(list(spacing))
 
 
-def resample(image, scan, new_spacing=[1, 1, 1]):
+def resample(image, scan, new_spacing=[1, 1, 1], order='cubic', output_dtype=None, n_threads=1):
     """
     A scan may have a pixel spacing of [2.5, 0.5, 0.5], which means that the distance between slices is
     2.5 millimeters. For a different scan this may be [1.5, 0.725, 0.725], this can be problematic for
@@ -61,13 +109,16 @@ def resample(image, scan, new_spacing=[1, 1, 1]):
     If we choose to resample everything to 1mm1mm1mm pixels we can use 3D convnets without worrying about
     learning zoom/slice thickness invariance.
     :param image:
-    :param scan:
+    :param scan: the slices from load_scan, or the (z, y, x) spacing of the scan
     :param new_spacing:
+    :param order: interpolation order, 'nearest', 'linear' or 'cubic' (see resampling.zoom_volume).
+        Use 'nearest' for masks.
+    :param output_dtype: defaults to image.dtype
+    :param n_threads: threads to resample chunks of the volume in
     :return:
     """
     # Determine current pixel spacing
-    spacing = map(float, ([scan[0].SliceThickness] + scan[0].PixelSpacing))
-    spacing = np.array(list(spacing))
+    spacing = scan_spacing(scan)
 
     resize_factor = spacing / new_spacing
     new_real_shape = image.shape * resize_factor
@@ -75,24 +126,17 @@ def resample(image, scan, new_spacing=[1, 1, 1]):
     real_resize_factor = new_shape / image.shape
     new_spacing = spacing / real_resize_factor
 
-    image = scipy.ndimage.interpolation.zoom(image, real_resize_factor)
+    image = resampling.zoom_volume(image, new_shape, order=order, output_dtype=output_dtype, n_threads=n_threads)
 
     return image, new_spacing
 
 
 def largest_label_volume(im, bg=-1):
-    vals, counts = np.unique(im, return_counts=True)
-
-    counts = counts[vals != bg]
-    vals = vals[vals != bg]
+    # np.bincount based (see components.py), im must hold non-negative labels
+    return components.largest_label(im, bg=bg)
 
-    if len(counts) > 0:
-        return vals[np.argmax(counts)]
-    else:
-        return None
 
-
-def segment_lung_mask(image, fill_lung_structures=True):
+def segment_lung_mask(image, fill_lung_structures=True, threshold=-320, n_threads=1):
     """
     In order to reduce the problem space, we can segment the lungs (and usually some tissue around it).
     The method that me and my student colleagues developed was quite effective.
@@ -106,12 +150,35 @@ def segment_lung_mask(image, fill_lung_structures=True):
     Keep only the largest air pocket (the human body has other pockets of air here and there).
     :param image:
     :param fill_lung_structures:
+    :param threshold: HU threshold between air and tissue
+    :param n_threads: threads to fill the axial slices in
     :return:
     """
+    binary_image = _threshold_and_fill_outside_air(image, threshold)
 
+    if fill_lung_structures:
+        _fill_lung_structures(binary_image, n_threads)
+
+    return _keep_largest_air_pocket(binary_image)
+
+
+def segment_lung_masks(image, threshold=-320, n_threads=1):
+    """
+    Same as calling segment_lung_mask with fill_lung_structures False and True, but the thresholding and the
+    3d connected component labelling of the air around the person are only done once.
+    :return: (segmented lungs, segmented lungs with the lung structures filled)
+    """
+    binary_image = _threshold_and_fill_outside_air(image, threshold)
+    binary_image_fill = binary_image.copy()
+    _fill_lung_structures(binary_image_fill, n_threads)
+    return _keep_largest_air_pocket(binary_image), _keep_largest_air_pocket(binary_image_fill)
+
+
+def _threshold_and_fill_outside_air(image, threshold=-320):
+    from skimage import measure
     # not actually binary, but 1 and 2.
     # 0 is treated as background, which we do not want
-    binary_image = np.array(image > -320, dtype=np.int8) + 1
+    binary_image = np.array(image > threshold, dtype=np.int8) + 1
     labels = measure.label(binary_image)
 
     # Pick the pixel in the very corner to determine which label is air.
@@ -122,22 +189,34 @@ def segment_lung_mask(image, fill_lung_structures=True):
 
     # Fill the air around the person
     binary_image[background_label == labels] = 2
+    return binary_image
 
 
+def _fill_lung_structures(binary_image, n_threads=1):
+    from skimage import measure
     # Method of filling the lung structures (that is superior to something like
-    # morphological closing)
-    if fill_lung_structures:
+    # morphological closing). Works on binary_image in place; slices are independent, so they can run in threads.
+    def fill_slice(i):
         # For every slice we determine the largest solid structure
-        for i, axial_slice in enumerate(binary_image):
-            axial_slice = axial_slice - 1
-            labeling = measure.label(axial_slice)
-            l_max = largest_label_volume(labeling, bg=0)
+        axial_slice = binary_image[i] - 1
+        labeling = measure.label(axial_slice)
+        l_max = largest_label_volume(labeling, bg=0)
 
-            if l_max is not None:  # This slice contains some lung
-                binary_image[i][labeling != l_max] = 1
+        if l_max is not None:  # This slice contains some lung
+            binary_image[i][labeling != l_max] = 1
 
-    binary_image -= 1  # Make the image actual binary
-    binary_image = 1 - binary_image  # Invert it, lungs are now 1
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(fill_slice, range(len(binary_image))))
+    else:
+        for i in range(len(binary_image)):
+            fill_slice(i)
+
+
+def _keep_largest_air_pocket(binary_image):
+    from skimage import measure
+    # Make the image actual binary and invert it, lungs are now 1 (in place: 2 - x maps 1, 2 to 1, 0)
+    np.subtract(2, binary_image, out=binary_image)
 
     # Remove other air pockets inside body
     labels = measure.label(binary_image, background=0)
@@ -148,11 +227,42 @@ def segment_lung_mask(image, fill_lung_structures=True):
     return binary_image
 
 
+def lung_bounding_box(lung_mask, margin=5):
+    """
+    :param lung_mask: masks.PackedMask of the (filled) lungs
+    :param margin: voxels to add around the lungs on every side
+    :return: ((z0, z1), (y0, y1), (x0, x1)) half open ranges, the whole volume if the mask is empty
+    """
+    box = lung_mask.bounding_box()
+    if box is None:
+        return tuple((0, n) for n in lung_mask.shape)
+    return tuple((max(lo - margin, 0), min(hi + margin, n)) for (lo, hi), n in zip(box, lung_mask.shape))
+
+
+def crop_to_lungs(pixels, lung_mask, target_shape=(24, 128, 128), margin=5, mask_outside=False, fill_value=-1000,
+                  order='linear'):
+    """
+    Crop the volume to the lungs' bounding box and resample the crop to a fixed shape, for training.
+    Cropping to the lungs typically removes most of the voxels. The crop is low-pass filtered before it is
+    shrunk (e.g. ~300 slices to 24, see resampling.antialias).
+    :param pixels: resampled HU volume
+    :param lung_mask: masks.PackedMask of the (filled) lungs
+    :param target_shape: shape of the result
+    :param margin: voxels kept around the lungs
+    :param mask_outside: set everything outside the lung mask to fill_value
+    :param order: interpolation order of the resampling (see resampling.zoom_volume)
+    :return: (cropped volume of shape target_shape, crop box in pixels' coordinates)
+    """
+    box = lung_bounding_box(lung_mask, margin)
+    cropped = pixels[tuple(slice(lo, hi) for lo, hi in box)]
+    if mask_outside:
+        cropped = np.where(lung_mask.crop(box) != 0, cropped, np.array(fill_value, dtype=pixels.dtype))
+    cropped = resampling.antialias(cropped, target_shape)
+    return resampling.zoom_volume(cropped, target_shape, order=order, output_dtype=pixels.dtype), box
+
+
 def normalize(image, min_bound=-1000., max_bound=400.):
-    image = (image - min_bound) / (max_bound - min_bound)
-    image[image > 1] = 1.
-    image[image < 0] = 0.
-    return image
+    return normalize_center(image, min_bound=min_bound, max_bound=max_bound, pixel_mean=0.)
 
 
 def zero_center(image, pixel_mean=.25):
@@ -160,42 +270,255 @@ def zero_center(image, pixel_mean=.25):
     return image
 
 
-def main():
-    # load, pre-process, and save the CT scans, although do zero centering and normalizing later <3
-    labels = pd.read_csv(config.input_data_dir + config.file_stage1_labels, index_col='id')
-    patients = os.listdir(config.input_images_dir)
-    patients.sort()
-    utils.safe_mkdirs(config.processed_images_dir)
-    for p in range(len(patients)):
-        pat = patients[p]
-        if pat != '.DS_Store' and p >= 1088:
+def normalize_center(image, out=None, dtype=np.float32, min_bound=-1000., max_bound=400., pixel_mean=.25):
+    """
+    zero_center(normalize(image)) in one pass over a single float32 array, instead of a float64 copy per step.
+    float16 results are computed in float32 and cast once, so they match normalize(...).astype(np.float16).
+    :param image: HU values of any dtype
+    :param out: float array of image's shape to write into (e.g. a slot of a batch); may be image itself
+    :param dtype: of the result if out isn't given
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if out.dtype.itemsize < 4:
+        out[...] = normalize_center(image, min_bound=min_bound, max_bound=max_bound, pixel_mean=pixel_mean)
+        return out
+    if out is not image:
+        out[...] = image
+    scale = 1. / (max_bound - min_bound)
+    out *= scale
+    out += -min_bound * scale - pixel_mean
+    return np.clip(out, -pixel_mean, 1. - pixel_mean, out=out)
+
+
+def window_uint8(image, min_bound=-1000., max_bound=400.):
+    """
+    The [min_bound, max_bound] HU window that normalize() keeps, quantized to 256 levels (~5.5 HU steps for the
+    default window), e.g. to store training crops at an eighth of the float64 / half of the int16 size.
+    """
+    image = np.clip(image, min_bound, max_bound).astype(np.float32)
+    image -= min_bound
+    image *= 255. / (max_bound - min_bound)
+    return np.round(image, out=image).astype(np.uint8)
+
+
+def uint8_to_hu(image, out=None, dtype=np.float32, min_bound=-1000., max_bound=400.):
+    """
+    Inverse of window_uint8 (up to its quantization), e.g. to augment a stored crop in HU.
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if out.dtype.itemsize < 4:
+        out[...] = uint8_to_hu(image, min_bound=min_bound, max_bound=max_bound)
+        return out
+    out[...] = image
+    out *= (max_bound - min_bound) / 255.
+    out += min_bound
+    return out
+
+
+def uint8_to_input(image, out=None, dtype=np.float32, pixel_mean=.25):
+    """
+    normalize_center() of a window_uint8() volume: one cast and two in place operations (in float32, also for
+    float16 results).
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if out.dtype.itemsize < 4:
+        out[...] = uint8_to_input(image, pixel_mean=pixel_mean)
+        return out
+    out[...] = image
+    out *= 1. / 255.
+    out -= pixel_mean
+    return out
+
+
+def to_input(image, out=None, dtype=np.float32):
+    """
+    Model input (normalized and zero centered) of a stored volume: window_uint8() ones or HU ones.
+    """
+    if image.dtype == np.uint8:
+        return uint8_to_input(image, out, dtype)
+    return normalize_center(image, out, dtype)
+
+
+def to_hu(image, out=None, dtype=np.float32):
+    """
+    HU values of a stored volume (window_uint8() ones are clipped to the window).
+    """
+    if image.dtype == np.uint8:
+        return uint8_to_hu(image, out, dtype)
+    if out is None:
+        return image.astype(dtype)
+    out[...] = image
+    return out
+
+
+def preprocess_stages(pat, cache):
+    """
+    Run load + HU -> resample -> segment for a patient, reusing every stage whose input and parameters are
+    unchanged since it was cached (see stage_cache.py). Stages are only loaded (or computed) if a later stage
+    needs them, so a cached resampled volume means the DICOM files aren't read at all.
+    :param cache: stage_cache.StageCache (a StageCache(None) caches nothing)
+    :return: (dict of the resampled pixels, both bit packed lung masks and the fixed shape crop of the lungs,
+              dict of the resampled spacing, the mask shapes, the shape of the scan before resampling and the
+              lung crop box)
+    """
+    path = config.input_images_dir + pat
+    # both are part of the stage keys, so changing either (see config.py) only recomputes the stages after it
+    new_spacing = list(config.new_spacing)
+    threshold = config.segment_threshold
+    hu_key = stage_cache.stage_key('hu', stage_cache.dicom_fingerprint(path))
+    resampled_key = stage_cache.stage_key('resample', hu_key,
+                                          dict(new_spacing=new_spacing, order=config.resample_order))
+    segmented_key = stage_cache.stage_key('segment', resampled_key, dict(threshold=threshold))
+
+    def load_hu():
+        with profiling.stage('load_scan'):
+            scan = load_scan(path, headers_only=True)
+        with profiling.stage('get_pixels_hu'):
+            pixels = get_pixels_hu(scan, n_threads=config.dicom_threads)
+        return {config.file_pixels: pixels}, dict(spacing=[float(x) for x in scan_spacing(scan)])
+
+    def resample_hu():
+        hu, hu_attrs = cache.cached('hu', hu_key, load_hu)
+        pixels = hu[config.file_pixels]
+        with profiling.stage('resample'):
+            pix_resampled, spacing = resample(pixels, hu_attrs['spacing'], new_spacing,
+                                              order=config.resample_order, n_threads=config.resample_threads)
+        return ({config.file_pixels_resampled: pix_resampled},
+                dict(spacing=[float(x) for x in spacing], original_shape=list(pixels.shape)))
+
+    resampled, resampled_attrs = cache.cached('resample', resampled_key, resample_hu)
+
+    def segment():
+        with profiling.stage('segment_lung_mask'):
+            lungs, lungs_fill = segment_lung_masks(resampled[config.file_pixels_resampled], threshold=threshold,
+                                                   n_threads=config.segment_threads)
+        # the lung masks are stored bit packed (see masks.py):
+        lungs = masks.PackedMask.from_array(lungs)
+        lungs_fill = masks.PackedMask.from_array(lungs_fill)
+        return ({config.file_segmented_lungs: lungs.bits, config.file_segmented_lungs_fill: lungs_fill.bits},
+                dict(mask_shapes={config.file_segmented_lungs: list(lungs.shape),
+                                  config.file_segmented_lungs_fill: list(lungs_fill.shape)}))
+
+    segmented, segmented_attrs = cache.cached('segment', segmented_key, segment)
+
+    with profiling.stage('crop_to_lungs'):
+        lungs_cropped, crop_box = crop_to_lungs(
+            resampled[config.file_pixels_resampled],
+            masks.PackedMask(segmented[config.file_segmented_lungs_fill],
+                             segmented_attrs['mask_shapes'][config.file_segmented_lungs_fill]),
+            target_shape=config.lung_crop_shape, margin=config.lung_crop_margin,
+            mask_outside=config.lung_crop_masked)
+
+    outputs = dict(resampled)
+    outputs.update(segmented)
+    if config.lung_crop_dtype == 'uint8':
+        # the training crops are only ever used normalized, i.e. within normalize()'s window
+        lungs_cropped = window_uint8(lungs_cropped)
+    outputs[config.file_lungs_cropped] = lungs_cropped
+    attrs = dict(resampled_attrs)
+    attrs.update(segmented_attrs)
+    attrs.update(lung_crop_box=[list(map(int, b)) for b in crop_box], lung_crop_masked=config.lung_crop_masked)
+    return outputs, attrs
+
+
+def preprocess_patient(pat, cancer_status='unknown'):
+    """
+    Load, pre-process, and save the CT scans of a single patient.
+    Runs in a worker process, so everything it needs is read from config.
+    :param pat: patient id (name of the patient's DICOM folder)
+    :param cancer_status: stored in the volume file's metadata
+    :return: (patient id, shape before resampling, shape after resampling)
+    """
+    profiling.set_patient(pat)
+    cache = stage_cache.StageCache(config.stage_cache_dir, config.stage_cache_max_bytes)
+    with profiling.stage('preprocess_stages'):
+        outputs, attrs = preprocess_stages(pat, cache)
+
+    # save the processed data:
+    volume_file = klc_utils.patient_volume_file(pat)
+    utils.safe_mkdirs(os.path.dirname(volume_file))
+    # save stuff (the scan's HU pixels are kept in the stage cache):
+    attrs.update(patient=pat, cancer_status=cancer_status)
+    with profiling.stage('hu_counts'):
+        hu_counts = histograms.hu_counts(outputs[config.file_pixels_resampled])
+    with profiling.stage('save_volumes'):
+        volume_store.save_volumes(volume_file,
+                                  [(name, outputs[name]) for name in [config.file_pixels_resampled,
+                                                                      config.file_segmented_lungs,
+                                                                      config.file_segmented_lungs_fill,
+                                                                      config.file_lungs_cropped]] +
+                                  [(config.file_hu_counts, hu_counts)],
+                                  attrs=attrs,
+                                  chunk_slices=config.volume_chunk_slices,
+                                  compress=config.volume_compress)
+
+    return pat, tuple(attrs['original_shape']), outputs[config.file_pixels_resampled].shape
+
+
+def patient_outputs(pat):
+    """
+    :return: the files preprocess_patient writes for a patient; all of them must be complete for it to count as done.
+    """
+    return [klc_utils.patient_volume_file(pat)]
 
-            print('Patient {}/{}: {}'.format(p+1, len(patients), pat))
-            scan = load_scan(config.input_images_dir + pat)
-            patient_pixels = get_pixels_hu(scan)
 
-            pix_resampled, spacing = resample(patient_pixels, scan, [1, 1, 1])
-            segmented_lungs = segment_lung_mask(pix_resampled, False)
-            segmented_lungs_fill = segment_lung_mask(pix_resampled, True)
+def outputs_complete(pat):
+    return all(volume_store.is_complete(f) for f in patient_outputs(pat))
 
-            print("\tShape before resampling: {}".format(patient_pixels.shape))
-            print("\tShape after resampling: {}".format(pix_resampled.shape))
 
-            # save the processed data:
-            patient_proc_data_dir = config.processed_images_dir + pat + '/'
-            utils.safe_mkdirs(patient_proc_data_dir)
-            # save stuff:
-            # np.save(file=patient_proc_data_dir + config.file_scan, arr=scan)
-            # np.save(file=patient_proc_data_dir + config.file_pixels, arr=patient_pixels)
-            np.save(file=patient_proc_data_dir + config.file_pixels_resampled, arr=pix_resampled)
-            np.save(file=patient_proc_data_dir + config.file_pixels_resampled_spacing, arr=spacing)
-            np.save(file=patient_proc_data_dir + config.file_segmented_lungs, arr=segmented_lungs)
-            np.save(file=patient_proc_data_dir + config.file_segmented_lungs_fill, arr=segmented_lungs_fill)
+def read_manifest(manifest_path):
+    """
+    The manifest is a plain text file with one completed patient id per line. It is only appended to after all of
+    a patient's outputs have been saved, so a crashed run never lists a half-written patient.
+    """
+    if not os.path.isfile(manifest_path):
+        return set()
+    with open(manifest_path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def pending_patients(patients, manifest_path):
+    # a patient is done only if it is in the manifest *and* its outputs are still on disk:
+    done = read_manifest(manifest_path)
+    return [pat for pat in patients
+            if pat not in done or not outputs_complete(pat)]
+
+
+def main(n_jobs=None):
+    # load, pre-process, and save the CT scans, although do zero centering and normalizing later <3
+    # Patients are fanned out over a process pool. Re-running main() picks up wherever the last run stopped.
+    labels = pd.read_csv(config.input_data_dir + config.file_stage1_labels, index_col='id')
+    patients = utils.list_patients(config.input_images_dir)
+    utils.safe_mkdirs(config.processed_images_dir)
+    manifest_path = config.processed_images_dir + config.file_manifest
+    todo = pending_patients(patients, manifest_path)
+    print('{}/{} patients already preprocessed, {} to go'.format(len(patients) - len(todo), len(patients), len(todo)))
+    if not todo:
+        return
+
+    jobs = [(pat, utils.get_patient_cancer_status(patient_id=pat, labels=labels)) for pat in todo]
+    # a patient that fails (e.g. a corrupt scan) is logged and left out of the manifest, so the next run retries
+    # it, but doesn't stop the others:
+    failed = []
+    with open(manifest_path, 'a') as manifest:
+        results = utils.run_pool(preprocess_patient, jobs, n_jobs or config.n_jobs, failed)
+        for i, (pat, shape, shape_resampled) in enumerate(results):
+            manifest.write(pat + '\n')
+            manifest.flush()
+            print('Patient {}/{}: {}'.format(i + 1, len(todo), pat))
+            print("\tShape before resampling: {}".format(shape))
+            print("\tShape after resampling: {}".format(shape_resampled))
+    if failed:
+        failed_patients = sorted(args[0] for args, _ in failed)
+        print('{}/{} patients failed: {}'.format(len(failed), len(todo), ', '.join(failed_patients)))
 
 
 # 4 dimensional convolutional neural network
 
 ##############
 if __name__ == '__main__':
-    # about two thirds done, Patient 1088/1596: ad7e6fe9d036ed070df718f95b212a10
+    config.parse_args()
     main()
@@ -0,0 +1,150 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+import pandas as pd
+import config, utils
+"""
+Stage level instrumentation of the pipeline. Every `with profiling.stage(name):` block appends one json line to
+config.profile_log with the stage, patient, process, wall and cpu seconds, bytes read / written and memory:
+
+    {"stage": "resample", "patient": "0a0c3...", "pid": 123, "wall_s": 9.1, "cpu_s": 9.0, "bytes_read": 0,
+     "bytes_written": 0, "rss_mb": 912.5, "peak_rss_mb": 1430.2, "error": null}
+
+cpu_s covers all threads of the process. bytes_read counts the bytes the stage made the process fetch from
+storage, including page faults of memory mapped volumes, but not page cache hits. bytes_written counts write
+system calls. peak_rss_mb is the stage's own peak: the process' high water mark is reset when a stage starts
+(and folded into the stages around it), so it doesn't just grow over the patients a pool worker handles; where
+it can't be reset (not linux) it is the process' high water mark. summary() aggregates a log per stage; the log
+accumulates over runs, so remove it to profile a fresh run.
+"""
+
+
+_patient = None
+# peak rss in MB so far of every stage open in this process, outermost first (stages nest, e.g. the cache_get_*
+# ones in preprocess_stages)
+_open_peaks = []
+
+
+def set_patient(pat):
+    """
+    Patient that the following stages of this process are recorded for.
+    """
+    global _patient
+    _patient = pat
+
+
+def _io_counters():
+    # linux only; zeros elsewhere
+    counters = dict(read_bytes=0, wchar=0)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024. ** 2
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _high_water_mark_mb():
+    # VmHWM, which unlike ru_maxrss can be reset (see _reset_high_water_mark)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError, ValueError):
+        pass
+    return peak_rss_mb()
+
+
+def _reset_high_water_mark():
+    # linux >= 4.0: resets VmHWM to the current rss
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _fold_peak():
+    # the high water mark since the last reset into every open stage, before it is reset or a stage ends
+    peak = _high_water_mark_mb()
+    _open_peaks[:] = [max(p, peak) for p in _open_peaks]
+
+
+def write_record(record, log_path=None):
+    log_path = log_path or config.profile_log
+    utils.safe_mkdirs(os.path.dirname(log_path) or '.')
+    with open(log_path, 'a') as f:
+        # one short write per line, so lines of concurrent worker processes don't interleave
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name, log_path=None):
+    """
+    Record the block as stage name. Does nothing if config.profile_log is None.
+    """
+    log_path = log_path or config.profile_log
+    if log_path is None:
+        yield
+        return
+    _fold_peak()
+    _reset_high_water_mark()
+    _open_peaks.append(0.)
+    io, wall, cpu = _io_counters(), time.time(), time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        io_end = _io_counters()
+        _fold_peak()
+        write_record(dict(stage=name, patient=_patient, pid=os.getpid(), wall_s=time.time() - wall,
+                          cpu_s=time.process_time() - cpu, bytes_read=io_end['read_bytes'] - io['read_bytes'],
+                          bytes_written=io_end['wchar'] - io['wchar'], rss_mb=_rss_mb(),
+                          peak_rss_mb=_open_peaks.pop(), error=error), log_path)
+
+
+def load_log(log_path=None):
+    return pd.read_json(log_path or config.profile_log, lines=True)
+
+
+def summary(log_path=None):
+    """
+    :return: per stage count, total / mean / max wall seconds, total cpu seconds, max peak rss and total bytes,
+        slowest stage first
+    """
+    log = load_log(log_path)
+    g = log.groupby('stage')
+    report = pd.DataFrame(dict(count=g.size(), wall_s_total=g.wall_s.sum(), wall_s_mean=g.wall_s.mean(),
+                               wall_s_max=g.wall_s.max(), cpu_s_total=g.cpu_s.sum(),
+                               peak_rss_mb_max=g.peak_rss_mb.max(), mb_read=g.bytes_read.sum() / 1024. ** 2,
+                               mb_written=g.bytes_written.sum() / 1024. ** 2, errors=g.error.count()),
+                          columns=['count', 'wall_s_total', 'wall_s_mean', 'wall_s_max', 'cpu_s_total',
+                                   'peak_rss_mb_max', 'mb_read', 'mb_written', 'errors'])
+    return report.sort_values('wall_s_total', ascending=False)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    print(summary())
@@ -0,0 +1,91 @@
+"""
+Score preprocessed patients with a trained model (see learn.make_model(save_path=...)) and write a
+submission style csv of per patient cancer probabilities.
+
+    python score.py --model model.h5 --patients data/stage2_sample_submission.csv --output submission.csv
+
+Patients are streamed through the model in batches while the next batches are loaded in the background, so
+memory use doesn't grow with the number of patients.
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import config, utils, klc_utils, loader, volume_store
+
+
+def score(model, patients, batch_size=24, n_workers=4, n_prefetch=2, lung_crops=True):
+    """
+    :param model: trained keras model with a 2 class (benign, cancerous) softmax output
+    :return: (DataFrame of id and cancer probability, DataFrame of per batch load / wait / predict seconds)
+    """
+    ids, probabilities, timings = [], [], []
+    batches = loader.prediction_batches(patients, batch_size=batch_size, n_workers=n_workers,
+                                        n_prefetch=n_prefetch, lung_crops=lung_crops)
+    while True:
+        t = time.time()
+        try:
+            batch_ids, x, load_seconds = next(batches)
+        except StopIteration:
+            break
+        # time spent waiting on the loader, i.e. not hidden by prefetching:
+        wait_seconds = time.time() - t
+        t = time.time()
+        p = model.predict(x, batch_size=len(x))
+        predict_seconds = time.time() - t
+        ids.extend(batch_ids)
+        probabilities.append(p[:, 1])
+        timings.append(dict(patients=len(batch_ids), load=load_seconds, wait=wait_seconds, predict=predict_seconds))
+    predictions = pd.DataFrame(dict(id=ids, cancer=np.concatenate(probabilities) if probabilities else []),
+                               columns=['id', 'cancer'])
+    return predictions, pd.DataFrame(timings, columns=['patients', 'load', 'wait', 'predict'])
+
+
+def latency_report(timings):
+    """
+    :return: mean, p50, p95 and total seconds per batch of each stage, plus overall patients per second
+    """
+    stages = timings[['load', 'wait', 'predict']]
+    report = pd.DataFrame(dict(mean=stages.mean(), p50=stages.quantile(.5), p95=stages.quantile(.95),
+                               total=stages.sum()), columns=['mean', 'p50', 'p95', 'total'])
+    total = timings.wait.sum() + timings.predict.sum()
+    return report, timings.patients.sum() / total if total else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='saved keras model')
+    parser.add_argument('--patients', default=None,
+                        help='csv with an id column of the patients to score (e.g. a sample submission); '
+                             'defaults to every preprocessed patient')
+    parser.add_argument('--output', default='submission.csv', help='csv to write')
+    parser.add_argument('--batch_size', type=int, default=24)
+    parser.add_argument('--n_workers', type=int, default=4, help='threads loading each batch')
+    parser.add_argument('--n_prefetch', type=int, default=2, help='batches loaded ahead')
+    config.add_arguments(parser)
+    args = parser.parse_args()
+    config.apply_arguments(args)
+
+    if args.patients is not None:
+        patients = list(pd.read_csv(args.patients).id)
+    else:
+        patients = utils.list_patients(config.processed_images_dir)
+    missing = [pat for pat in patients
+               if not volume_store.is_complete(klc_utils.patient_volume_file(pat))]
+    if missing:
+        raise SystemExit('{} patients are not preprocessed, e.g. {}'.format(len(missing), missing[0]))
+
+    from keras import models
+    model = models.load_model(args.model)
+    predictions, timings = score(model, patients, batch_size=args.batch_size, n_workers=args.n_workers,
+                                 n_prefetch=args.n_prefetch)
+    predictions.to_csv(args.output, index=False)
+    report, patients_per_second = latency_report(timings)
+    print('Scored {} patients into {}'.format(len(predictions), args.output))
+    print('Seconds per batch:')
+    print(report)
+    print('{:.1f} patients / second'.format(patients_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import numpy as np
+import utils, volume_store, profiling
+"""
+Content addressed cache for the preprocessing stages (load + HU -> resample -> segment).
+
+A stage's key is a hash of the stage name, its parameters and the key of the stage it consumes; the first stage
+is keyed on a fingerprint of the patient's DICOM folder. Changing a parameter therefore only invalidates that
+stage and the ones after it, e.g. tuning the segmentation threshold reuses the cached resampled volumes.
+
+Entries are volume files (see volume_store.py) under cache_dir/<stage>/<key>.vol. Reading an entry touches its
+mtime, and after every write the least recently used entries are removed until the cache fits in max_bytes.
+"""
+
+
+def dicom_fingerprint(path):
+    """
+    Cheap fingerprint of a DICOM folder: its path and the names, sizes and modification times of its files
+    (no file is read).
+    """
+    h = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+    for f in sorted(os.listdir(path)):
+        st = os.stat(os.path.join(path, f))
+        h.update('{}:{}:{}\n'.format(f, st.st_size, int(st.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def stage_key(stage, parent_key, params=None):
+    """
+    :param stage: stage name
+    :param parent_key: key (or input fingerprint) of what the stage consumes
+    :param params: json serializable dict of everything else that changes the stage's output
+    """
+    desc = json.dumps(dict(stage=stage, parent=parent_key, params=params or {}), sort_keys=True)
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """
+    :param cache_dir: where to keep the entries; None disables caching (everything is recomputed)
+    :param max_bytes: size limit of the cache, None for no limit
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key + '.vol')
+
+    def get(self, stage, key):
+        """
+        :return: (dict of arrays, attrs) stored under key, or None
+        """
+        if self.cache_dir is None:
+            return None
+        path = self.path(stage, key)
+        try:
+            volumes = volume_store.VolumeFile(path)
+            arrays = dict((name, np.array(volumes.load(name))) for name in volumes.names)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # missing, or evicted by another worker while we read it
+            return None
+        return arrays, volumes.attrs
+
+    def put(self, stage, key, arrays, attrs=None):
+        if self.cache_dir is None:
+            return
+        utils.safe_mkdirs(os.path.join(self.cache_dir, stage))
+        volume_store.save_volumes(self.path(stage, key), arrays, attrs=attrs)
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (mtime, size, path) of all cache entries
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.vol'):
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        if self.cache_dir is None or self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            utils.safe_remove(path)
+            total -= size
+
+    def cached(self, stage, key, compute):
+        """
+        :param compute: function returning (arrays, attrs), called only if key isn't cached
+        :return: (arrays, attrs)
+        """
+        with profiling.stage('cache_get_' + stage):
+            hit = self.get(stage, key)
+        if hit is not None:
+            return hit
+        arrays, attrs = compute()
+        with profiling.stage('cache_put_' + stage):
+            self.put(stage, key, arrays, attrs)
+        return arrays, attrs
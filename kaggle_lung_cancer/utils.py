@@ -1,5 +1,7 @@
 import os
+import multiprocessing
 import tempfile
+import traceback
 
 
 def safe_remove(f):
@@ -30,6 +32,52 @@ def file_dir(file=__file__):
     return os.path.dirname(os.path.realpath(file)) + '/'
 
 
+def _call(job):
+    # Pool.imap only passes a single argument. A job's exception is returned instead of raised: raised, it would
+    # end the imap and take every job still in flight down with it.
+    fn, args = job
+    try:
+        return args, fn(*args), None
+    except Exception:
+        return args, None, traceback.format_exc()
+
+
+def run_pool(fn, jobs, n_jobs=None, failed=None):
+    """
+    Run fn(*args) for every args in jobs on a process pool. Jobs that raise are logged and skipped.
+    :param fn: module level function (it is pickled to the workers)
+    :param jobs: list of argument tuples
+    :param n_jobs: number of processes, defaults to one per cpu
+    :param failed: list to append (args, traceback) of every job that raised to
+    :return: generator of the results of the jobs that succeeded, in the order they finish. The pool is
+        terminated if the consumer stops early or raises.
+    """
+    pool = multiprocessing.Pool(processes=n_jobs or multiprocessing.cpu_count())
+    try:
+        for args, result, error in pool.imap_unordered(_call, [(fn, args) for args in jobs]):
+            if error is not None:
+                print('{}{} failed:\n{}'.format(fn.__name__, args, error))
+                if failed is not None:
+                    failed.append((args, error))
+                continue
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def list_patients(images_dir):
+    """
+    :return: sorted patient ids, i.e. the patient folders in images_dir
+    """
+    patients = [p for p in os.listdir(images_dir) if os.path.isdir(os.path.join(images_dir, p))]
+    patients.sort()
+    return patients
+
+
 def get_patient_cancer_status(patient_id, labels):
     if patient_id in labels.index:
         cancer_status = ['benign', 'cancerous'][labels.cancer[patient_id]]
@@ -0,0 +1,187 @@
+import json
+import os
+import struct
+import zlib
+import numpy as np
+"""
+A small chunked volume container, so that a patient's volumes can be kept in one file and read a slice or a
+sub-cube at a time instead of always loading every full array with np.load.
+
+File layout:
+    magic | chunk, chunk, ... | json header | 8 byte (little endian) offset of the json header
+
+Every array is split into chunks of `chunk_slices` slices along the first (axial) axis. Chunks are either raw
+(C order bytes, so the whole array is contiguous on disk and can be memory mapped) or zlib compressed.
+The header holds, per array, its shape, dtype, chunking, compression and chunk offsets, plus free-form attrs
+for the whole file (e.g. spacing).
+"""
+
+
+MAGIC = b'KLCVOL1\n'
+_footer = struct.Struct('<Q')
+
+
+def save_volumes(path, arrays, attrs=None, chunk_slices=16, compress=False, compress_level=1):
+    """
+    :param path: file to write
+    :param arrays: list of (name, array) pairs (or a dict) to store
+    :param attrs: json serializable dict of metadata for the whole file, e.g. dict(spacing=[1, 1, 1])
+    :param chunk_slices: number of axial slices per chunk
+    :param compress: zlib compress each chunk. Compressed arrays can't be memory mapped.
+    :param compress_level: zlib compression level
+    """
+    if isinstance(arrays, dict):
+        arrays = list(arrays.items())
+    header = dict(attrs=attrs or {}, arrays={}, order=[])
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        for name, arr in arrays:
+            # not ascontiguousarray, which turns 0-d arrays (scalars) into shape (1,)
+            arr = np.asarray(arr, order='C')
+            chunks = []
+            for start in range(0, max(arr.shape[0], 1) if arr.ndim else 1, chunk_slices):
+                block = arr[start:start + chunk_slices] if arr.ndim else arr
+                data = block.tobytes()
+                if compress:
+                    data = zlib.compress(data, compress_level)
+                chunks.append([f.tell(), len(data)])
+                f.write(data)
+            header['arrays'][name] = dict(shape=list(arr.shape), dtype=arr.dtype.str, chunk_slices=chunk_slices,
+                                          compression='zlib' if compress else None, chunks=chunks)
+            header['order'].append(name)
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode('utf-8'))
+        f.write(_footer.pack(header_offset))
+    # only ever expose complete files under the real name:
+    os.replace(tmp_path, path)
+
+
+class Volume(object):
+    """
+    One array inside a volume file. Index it like a numpy array; only the chunks covering the requested
+    axial slices are read (and decompressed).
+    """
+
+    def __init__(self, path, name, info):
+        self.path = path
+        self.name = name
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.chunk_slices = info['chunk_slices']
+        self.compression = info['compression']
+        self.chunks = info['chunks']
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _read_chunks(self, first, last):
+        # returns slices [first * chunk_slices, min((last + 1) * chunk_slices, n)) as an array
+        slice_shape = self.shape[1:]
+        blocks = []
+        with open(self.path, 'rb') as f:
+            for c in range(first, last + 1):
+                offset, nbytes = self.chunks[c]
+                f.seek(offset)
+                data = f.read(nbytes)
+                if self.compression == 'zlib':
+                    data = zlib.decompress(data)
+                blocks.append(np.frombuffer(data, dtype=self.dtype).reshape((-1,) + slice_shape))
+        return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+    def read(self):
+        """
+        :return: the full array (a memory map if the array is stored uncompressed)
+        """
+        if self.ndim == 0 or self.shape[0] == 0:
+            return self._read_chunks(0, 0).reshape(self.shape)
+        if self.compression is None:
+            return self.memmap()
+        return self._read_chunks(0, len(self.chunks) - 1)
+
+    def memmap(self, mode='r'):
+        if self.compression is not None:
+            raise ValueError('{} is compressed and can not be memory mapped'.format(self.name))
+        return np.memmap(self.path, dtype=self.dtype, mode=mode, offset=self.chunks[0][0], shape=self.shape)
+
+    def __getitem__(self, key):
+        if self.ndim == 0:
+            return self.read()[key]
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if self.compression is None:
+            return np.array(self.memmap()[key])
+
+        if isinstance(first, slice):
+            idx = np.arange(*first.indices(self.shape[0]))
+            if len(idx) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+        else:
+            idx = int(first)
+            if idx < 0:
+                idx += self.shape[0]
+            if not 0 <= idx < self.shape[0]:
+                raise IndexError('index {} out of range for axis 0 with size {}'.format(first, self.shape[0]))
+        # only read the chunks covering the requested slices:
+        c0 = np.min(idx) // self.chunk_slices
+        block = self._read_chunks(c0, np.max(idx) // self.chunk_slices)
+        return np.array(block[(idx - c0 * self.chunk_slices,) + rest])
+
+    def get_slice(self, i):
+        return self[i]
+
+    def get_subvolume(self, start, shape):
+        """
+        :param start: (z, y, x) corner of the sub-cube
+        :param shape: (depth, height, width) of the sub-cube, e.g. (24, 128, 128)
+        """
+        return self[tuple(slice(s, s + n) for s, n in zip(start, shape))]
+
+
+class VolumeFile(object):
+    """
+    Read side of save_volumes:
+        vf = VolumeFile(path)
+        vf.attrs['spacing']
+        vf['pixels_resampled'][80]            # one slice
+        vf['pixels_resampled'][40:64, :128, :128]  # one sub-cube
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a volume file'.format(path))
+            f.seek(-_footer.size, 2)
+            end = f.tell()
+            header_offset, = _footer.unpack(f.read(_footer.size))
+            f.seek(header_offset)
+            header = json.loads(f.read(end - header_offset).decode('utf-8'))
+        self.attrs = header['attrs']
+        self.names = header['order']
+        self._arrays = header['arrays']
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __getitem__(self, name):
+        return Volume(self.path, name, self._arrays[name])
+
+    def load(self, name):
+        return self[name].read()
+
+
+def is_complete(path):
+    """
+    :return: True if path is a readable volume file (save_volumes writes to a temp file and renames it at the end)
+    """
+    try:
+        VolumeFile(path)
+        return True
+    except (IOError, OSError, ValueError, struct.error):
+        return False
@@ -29,6 +29,9 @@ from __future__ import division
 from __future__ import print_function
 import argparse
 import sys
+import threading
+import time
+import numpy as np
 from tensorflow.examples.tutorials.mnist import input_data
 import tensorflow as tf
 
@@ -38,19 +41,19 @@ FLAGS = None
 # FLAGS.data_dir = "MNIST_data/"
 
 
-def main(_):
-    # Import data
-    mnist = input_data.read_data_sets(FLAGS.data_dir, one_hot=True)
-
-    # Create the model
-    x = tf.placeholder(tf.float32, [None, 784])
+def softmax_regression():
+    """
+    :return: function mapping (n, 784) images to (n, 10) logits; every call shares the same weights
+    """
     W = tf.Variable(tf.zeros([784, 10]))
     b = tf.Variable(tf.zeros([10]))
-    y = tf.matmul(x, W) + b
 
-    # Define loss and optimizer
-    y_ = tf.placeholder(tf.float32, [None, 10])
+    def model(x):
+        return tf.matmul(x, W) + b
+    return model
 
+
+def train_op(y, y_, learning_rate=0.5):
     # The raw formulation of cross-entropy,
     #
     #   tf.reduce_mean(-tf.reduce_sum(y_ * tf.log(tf.nn.softmax(y)),
@@ -60,27 +63,140 @@ def main(_):
     #
     # So here we use tf.nn.softmax_cross_entropy_with_logits on the raw
     # outputs of 'y', and then average across the batch.
-    cross_entropy = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(y, y_))
-    train_step = tf.train.GradientDescentOptimizer(0.5).minimize(cross_entropy)
+    cross_entropy = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=y, labels=y_))
+    return tf.train.GradientDescentOptimizer(learning_rate).minimize(cross_entropy)
+
+
+def start_producers(sess, coord, enqueue_op, close_op, images_ph, labels_ph, images, labels, batch_size,
+                    n_producers, batches_per_enqueue=4, seed=0):
+    """
+    Background threads that shuffle the training set and push it into the input queue, several batches per
+    enqueue call, so that slicing the numpy arrays and copying them into the session overlaps with training.
+    Every producer walks its own permutation (DataSet.next_batch isn't thread safe). A failing producer closes
+    the queue (close_op), so that a pending dequeue fails instead of waiting forever.
+    """
+    chunk = batch_size * batches_per_enqueue
+
+    def produce(i):
+        rng = np.random.RandomState(seed + i)
+        try:
+            while not coord.should_stop():
+                order = rng.permutation(len(images))
+                for start in range(0, len(order) - chunk + 1, chunk):
+                    if coord.should_stop():
+                        return
+                    idx = np.sort(order[start:start + chunk])
+                    sess.run(enqueue_op, feed_dict={images_ph: images[idx], labels_ph: labels[idx]})
+        except (tf.errors.CancelledError, tf.errors.AbortedError):
+            # the queue was closed at shutdown
+            pass
+        except Exception as e:
+            sess.run(close_op)
+            coord.request_stop(e)
+
+    threads = [threading.Thread(target=produce, args=(i,)) for i in range(n_producers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    return threads
+
+
+def evaluate(sess, n_correct, x, y_, images, labels, batch_size):
+    """
+    Accuracy streamed over chunks of batch_size examples, instead of a single feed of the whole set.
+    """
+    correct = 0
+    for start in range(0, len(images), batch_size):
+        correct += sess.run(n_correct, feed_dict={x: images[start:start + batch_size],
+                                                  y_: labels[start:start + batch_size]})
+    return correct / len(images)
+
+
+def main(_):
+    # Import data
+    mnist = input_data.read_data_sets(FLAGS.data_dir, one_hot=True)
+
+    # Create the model
+    model = softmax_regression()
+
+    # Inputs: either fed every step, or dequeued from a queue that background threads keep full
+    x = tf.placeholder(tf.float32, [None, 784])
+    y_ = tf.placeholder(tf.float32, [None, 10])
+    if FLAGS.input_mode == 'queue':
+        queue = tf.FIFOQueue(FLAGS.queue_batches * FLAGS.batch_size, [tf.float32, tf.float32],
+                             shapes=[[784], [10]])
+        enqueue_op = queue.enqueue_many([x, y_])
+        close_op = queue.close(cancel_pending_enqueues=True)
+        train_x, train_y = queue.dequeue_many(FLAGS.batch_size)
+    else:
+        train_x, train_y = x, y_
+    y = model(train_x)
+
+    # Define loss and optimizer
+    train_step = train_op(y, train_y)
+
+    # Test trained model (on the placeholders, whatever the training input mode)
+    correct_prediction = tf.equal(tf.argmax(model(x), 1), tf.argmax(y_, 1))
+    n_correct = tf.reduce_sum(tf.cast(correct_prediction, tf.float32))
+
+    sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=FLAGS.n_threads,
+                                            inter_op_parallelism_threads=FLAGS.n_threads))
+    sess.run(tf.global_variables_initializer())
+    coord = tf.train.Coordinator()
+    threads = []
+    if FLAGS.input_mode == 'queue':
+        threads = start_producers(sess, coord, enqueue_op, close_op, x, y_, mnist.train.images,
+                                  mnist.train.labels, FLAGS.batch_size, FLAGS.n_producers)
 
-    sess = tf.InteractiveSession()
-    tf.global_variables_initializer().run()
     # Train
-    for _ in range(1000):
-        batch_xs, batch_ys = mnist.train.next_batch(100)
-        sess.run(train_step, feed_dict={x: batch_xs, y_: batch_ys})
+    step_seconds = []
+    try:
+        for step in range(FLAGS.steps):
+            if coord.should_stop():
+                break
+            start = time.time()
+            if FLAGS.input_mode == 'queue':
+                try:
+                    sess.run(train_step)
+                except tf.errors.OutOfRangeError:
+                    # a producer failed and closed the queue; coord.join below raises its error
+                    break
+            else:
+                batch_xs, batch_ys = mnist.train.next_batch(FLAGS.batch_size)
+                sess.run(train_step, feed_dict={x: batch_xs, y_: batch_ys})
+            step_seconds.append(time.time() - start)
+            if FLAGS.log_every and (step + 1) % FLAGS.log_every == 0:
+                recent = step_seconds[-FLAGS.log_every:]
+                print('step {}: {:.0f} examples/sec (last step {:.0f})'.format(
+                    step + 1, FLAGS.batch_size * len(recent) / sum(recent), FLAGS.batch_size / recent[-1]))
+    finally:
+        coord.request_stop()
+        if FLAGS.input_mode == 'queue':
+            sess.run(close_op)
+        coord.join(threads)
 
-    # Test trained model
-    correct_prediction = tf.equal(tf.argmax(y, 1), tf.argmax(y_, 1))
-    accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
+    # skip the first steps (graph warm up) if there are enough of them
+    timed = step_seconds[10:] if len(step_seconds) > 20 else step_seconds
+    if timed:
+        print('Training: {:.0f} examples/sec over {} steps ({} input, batch size {})'.format(
+            FLAGS.batch_size * len(timed) / sum(timed), len(step_seconds), FLAGS.input_mode, FLAGS.batch_size))
     print('Test set prediction accuracy: {}'.format(
-        sess.run(accuracy, feed_dict={x: mnist.test.images,
-                                      y_: mnist.test.labels})))
+        evaluate(sess, n_correct, x, y_, mnist.test.images, mnist.test.labels, FLAGS.eval_batch_size)))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, default='/tmp/tensorflow/mnist/input_data',
                         help='Directory for storing input data')
+    parser.add_argument('--input_mode', type=str, default='queue', choices=['queue', 'feed_dict'],
+                        help='queue: background threads keep an input queue full; feed_dict: feed every step')
+    parser.add_argument('--batch_size', type=int, default=100, help='Training examples per step')
+    parser.add_argument('--steps', type=int, default=1000, help='Training steps')
+    parser.add_argument('--n_producers', type=int, default=2, help='Threads filling the input queue')
+    parser.add_argument('--queue_batches', type=int, default=16, help='Capacity of the input queue, in batches')
+    parser.add_argument('--eval_batch_size', type=int, default=1000, help='Test examples per evaluation step')
+    parser.add_argument('--n_threads', type=int, default=0,
+                        help='Threads tensorflow uses for its ops; 0 lets it pick')
+    parser.add_argument('--log_every', type=int, default=100, help='Report examples/sec every n steps, 0 never')
     FLAGS, unparsed = parser.parse_known_args()
     tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)